@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+from collections import Counter
+
+# Reductions of the dashboard specs (example.ssd files):
+#   sum:                 total of every trace (booleans count as 0/1)
+#   unique_trace_counts: number of entities per distinct value of every trace
+REDUCERS = ("sum", "unique_trace_counts")
+CACHE_TTL_SECONDS = 300
+
+# Results of earlier aggregations: cache key -> (time, result), shared by the threads of
+# concurrently processed services and therefore only accessed while holding the lock
+_aggregate_cache = {}
+_aggregate_cache_lock = threading.Lock()
+
+
+def parse_ssd(path):
+    """
+    Reads a dashboard spec (.ssd) into a dict of sections. "key is value" lines become
+    strings, "key -> a, b" lines lists.
+    """
+    sections = {}
+    section = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            if not line[0].isspace() and line.rstrip().endswith(":"):
+                section = sections.setdefault(line.strip()[:-1], {})
+            elif section is not None and " -> " in line:
+                key, values = line.split(" -> ", 1)
+                section[key.strip()] = [value.strip() for value in values.split(",") if value.strip()]
+            elif section is not None and " is " in line:
+                key, value = line.split(" is ", 1)
+                section[key.strip()] = value.strip()
+    return sections
+
+
+def get_reduce_panels(sections):
+    """
+    Returns the panels of a parsed dashboard spec which declare a reduction, as dicts with
+    the panel name, the entity type of its source, its traces and the reduction.
+    """
+    panels = []
+    for name in sections.get("application", {}).get("panels", []):
+        panel = sections.get(name, {})
+        if "reduce" not in panel:
+            continue
+        source = sections.get(panel.get("source"), {})
+        panels.append({"name": name, "type": source.get("query"), "traces": panel.get("traces", []),
+                       "reduce": panel["reduce"]})
+    return panels
+
+
+def create_reducer(reduce):
+    """
+    Returns the initial state of a reduction.
+    """
+    if reduce not in REDUCERS:
+        raise ValueError(f"Unknown reduction {reduce}, expected one of {', '.join(REDUCERS)}")
+    return {}
+
+
+def update_reducer(state, reduce, traces, entity):
+    """
+    Adds the values of one entity (in keyValues format) to the state of a reduction.
+    """
+    for trace in traces:
+        value = entity.get(trace)
+        if isinstance(value, dict) and "value" in value:
+            value = value["value"]
+        if reduce == "sum":
+            if isinstance(value, (bool, int, float)):
+                state[trace] = state.get(trace, 0) + value
+        elif value is not None:
+            counts = state.get(trace)
+            if counts is None:
+                counts = state[trace] = Counter()
+            # Lists and objects are counted by their JSON text
+            counts[value if isinstance(value, (str, int, float, bool)) else json.dumps(value, sort_keys=True)] += 1
+
+
+def finish_reducer(state, reduce, traces):
+    """
+    Returns the result of a reduction: {trace: total} for sum, {trace: {value: count}}
+    (most frequent first) for unique_trace_counts.
+    """
+    if reduce == "sum":
+        return {trace: state.get(trace, 0) for trace in traces}
+    return {trace: dict(state.get(trace, Counter()).most_common()) for trace in traces}
+
+
+def aggregate_entities(entities, reductions):
+    """
+    Computes several reductions in a single pass over entities. Only the running totals
+    and the counts of the distinct values are kept, not the entities.
+
+    Args:
+        entities: Iterable of entities (normalized or keyValues format)
+        reductions: List of (traces, reduce) tuples
+
+    Returns:
+        Tuple of the list of results (one per reduction) and the number of entities
+    """
+    states = [create_reducer(reduce) for _, reduce in reductions]
+    count = 0
+    for entity in entities:
+        count += 1
+        for state, (traces, reduce) in zip(states, reductions):
+            update_reducer(state, reduce, traces, entity)
+    return [finish_reducer(state, reduce, traces) for state, (traces, reduce) in zip(states, reductions)], count
+
+
+def get_client_scope(client):
+    """
+    Returns the instance (endpoint) and service of a client, the first part of its cache keys.
+    """
+    endpoint = getattr(client, "endpoint", None) or ",".join(getattr(client, "endpoints", []))
+    return [endpoint, client.service]
+
+
+def get_cache_key(client, type, traces, reduce, filters):
+    """
+    Returns the cache key of an aggregation: instance, service, type, traces, reduction and filters.
+    """
+    active_filters = sorted((key, value) for key, value in filters.items() if value is not None)
+    return json.dumps(get_client_scope(client) + [type, sorted(traces), reduce, active_filters])
+
+
+def load_cache(cache_path):
+    """
+    Loads the aggregation results stored in a cache file into the in-memory cache.
+    """
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, "r", encoding="utf-8") as f:
+            entries = json.load(f)
+        with _aggregate_cache_lock:
+            for key, (timestamp, result) in entries.items():
+                if key not in _aggregate_cache or _aggregate_cache[key][0] < timestamp:
+                    _aggregate_cache[key] = (timestamp, result)
+
+
+def save_cache(cache_path, client, ttl=CACHE_TTL_SECONDS):
+    """
+    Writes the unexpired aggregation results of the instance and service of a client to a cache file.
+    """
+    now = time.time()
+    scope = get_client_scope(client)
+    with _aggregate_cache_lock:
+        snapshot = list(_aggregate_cache.items())
+    entries = {key: entry for key, entry in snapshot if now - entry[0] < ttl and json.loads(key)[:2] == scope}
+    # Unique temporary file, several threads or processes may save the same cache
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(entries, f)
+    os.replace(tmp_path, cache_path)
+
+
+def aggregate_panels(client, panels, ttl=CACHE_TTL_SECONDS, cache_path=None, page_size=1000, **filters):
+    """
+    Computes the reductions of dashboard panels. Results younger than ttl seconds are taken
+    from the cache, all other panels of the same entity type are computed together in one
+    streaming pass which fetches only their traces (attrs) in keyValues format.
+
+    Args:
+        client: FiwareClient (or ShardedFiwareClient) of the service
+        panels: List of dicts with "name", "type", "traces" and "reduce" (see get_reduce_panels)
+        ttl: Number of seconds a cached result is used
+        cache_path: JSON file the cache is kept in between runs (in memory only if None)
+        page_size: Number of entities fetched per request
+        filters: Query filters (see FiwareClient.get_query_params)
+
+    Returns:
+        Dict of panel name -> result
+    """
+    load_cache(cache_path)
+    now = time.time()
+    results = {}
+    missing = {}
+    for panel in panels:
+        create_reducer(panel["reduce"])
+        key = get_cache_key(client, panel["type"], panel["traces"], panel["reduce"], filters)
+        with _aggregate_cache_lock:
+            cached = _aggregate_cache.get(key)
+        if cached is not None and now - cached[0] < ttl:
+            results[panel["name"]] = cached[1]
+            print(f"Panel {panel['name']}: cached result ({now - cached[0]:.0f} s old)")
+        else:
+            missing.setdefault(panel["type"], []).append((panel, key))
+
+    for type, type_panels in missing.items():
+        start_time = time.time()
+        traces = sorted({trace for panel, _ in type_panels for trace in panel["traces"]})
+        entities = client.iter_all_entities(type, page_size, attrs=",".join(traces), options="keyValues", **filters)
+        type_results, count = aggregate_entities(entities, [(panel["traces"], panel["reduce"]) for panel, _ in type_panels])
+        print(f"Aggregated {count} entities of type {type} for {len(type_panels)} panels ({time.time() - start_time:.2f} s)")
+        for (panel, key), result in zip(type_panels, type_results):
+            with _aggregate_cache_lock:
+                _aggregate_cache[key] = (time.time(), result)
+            results[panel["name"]] = result
+
+    if cache_path:
+        save_cache(cache_path, client, ttl)
+    return results
+
+
+def aggregate(client, type, traces, reduce, ttl=CACHE_TTL_SECONDS, cache_path=None, **filters):
+    """
+    Computes one reduction (see REDUCERS) over the traces of all entities of a type,
+    see aggregate_panels.
+    """
+    panel = {"name": reduce, "type": type, "traces": list(traces), "reduce": reduce}
+    return aggregate_panels(client, [panel], ttl, cache_path, **filters)[reduce]
@@ -3,17 +3,50 @@
 
 from dataclasses import dataclass
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import re
 from datetime import datetime
 from dateutil import parser
+from geometry_helper import compact_entities, MAX_ENTITY_SIZE_BYTES
+from validation_helper import iter_valid_entities
+from entity_file_helper import write_entities
 
+# actionType values of /op/update used for uploads:
+#   append_strict: create entities, fails for entities that already exist
+#   append:        create entities or add/overwrite the given attributes of existing ones
+#   update:        overwrite the given attributes of existing entities, fails for missing entities
+#   replace:       replace all attributes of existing entities, fails for missing entities
+UPLOAD_MODES = ("append_strict", "append", "update", "replace")
+
+# Errors which reject a batch as a whole (nothing is stored), so the batch is split to find
+# the offending entities. Other errors are not split: a 422 is a partial failure (/op/update
+# is not atomic, the entities not listed in the error were stored), and for server,
+# authorization and rate limit errors every part would fail the same way.
+BISECTABLE_STATUS_CODES = (400, 413)
+PARTIAL_FAILURE_STATUS_CODE = 422
+
+def create_session(max_connections=10):
+    """
+    Creates a requests session whose connection pool keeps up to max_connections
+    connections per host open. One session can be shared by several clients and threads.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+# __slots__ is declared explicitly because @dataclass(slots=True) needs Python 3.10
 @dataclass
 class MeasurementRequest():
+    __slots__ = ("urn", "name")
     urn: str
     name: str
 
 @dataclass
 class MeasurementResult():
+    __slots__ = ("urn", "name", "value", "timestamp")
     urn: str
     name: str
     value: str
@@ -23,59 +56,208 @@ class FiwareClient():
     """
     Class that implements the Fiware NGSI v2 API.
     """
-    def __init__(self, endpoint, token, service=None) -> None:
+    def __init__(self, endpoint, token, service=None, session=None) -> None:
         """
         Constructor accepts two parameters:
         @param endpoint: URL of API endpoint.
         @param token: access token.
         @param service: service path.
+        @param session: requests session to send the requests with (e.g. shared by the clients of several services, see create_session).
         """
         self.endpoint = endpoint
         self.token = token
         self.service = service
+        self.session = session if session is not None else requests.Session()
         
-    def send_get(self, request):
+    def send_get(self, request, params=None):
         """
         Helper method that sends a GET request with the authorization token
         """
-        return requests.get(request, headers = {"X-Auth-Token": self.token, "fiware-service": self.service})
+        return self.session.get(request, headers = {"X-Auth-Token": self.token, "fiware-service": self.service}, params = params)
     
     def send_post(self, request, body):
         """
         Helper method that sends a POST request with the authorization token
         """
-        return requests.post(request, headers = {"X-Auth-Token": self.token, "fiware-service": self.service}, json = body)
+        return self.session.post(request, headers = {"X-Auth-Token": self.token, "fiware-service": self.service}, json = body)
+
+    def send_delete(self, request):
+        """
+        Helper method that sends a DELETE request with the authorization token
+        """
+        return self.session.delete(request, headers = {"X-Auth-Token": self.token, "fiware-service": self.service})
+
+    def get_query_params(self, type=None, q=None, mq=None, georel=None, geometry=None, coords=None,
+                         id_pattern=None, order_by=None):
+        """
+        Builds the query parameters of an entity query. All filters are evaluated by Orion.
+
+        Args:
+            type: Entity type (comma separated list for several types)
+            q: Attribute filter, e.g. "capacity>100;district==7"
+            mq: Metadata filter, e.g. "temperature.accuracy<0.5"
+            georel: Geographical relationship, e.g. "near;maxDistance:1000" or "coveredBy" (requires geometry and coords)
+            geometry: Reference geometry type: point, line, polygon or box
+            coords: Coordinates of the reference geometry, e.g. "48.2,16.37"
+            id_pattern: Regular expression the entity ids have to match
+            order_by: Comma separated attributes to sort by, prefix with ! for descending order
+        """
+        if (georel is not None or geometry is not None or coords is not None) and None in (georel, geometry, coords):
+            raise ValueError("A geographical query needs georel, geometry and coords")
+        params = {
+            "type": type,
+            "q": q,
+            "mq": mq,
+            "georel": georel,
+            "geometry": geometry,
+            "coords": coords,
+            "idPattern": id_pattern,
+            "orderBy": order_by,
+        }
+        return {key: value for key, value in params.items() if value is not None}
+
+    def get_entities_page(self, type=None, offset=0, page_size=1000, attrs=None, options=None, **filters):
+        """
+        Gets one page of the entities of a given type (if type provided) matching the
+        filters (see get_query_params).
+        @param attrs: comma separated attributes to return (all if None).
+        @param options: query options, e.g. "keyValues" or "dateModified".
+        """
+        params = self.get_query_params(type, **filters)
+        params["limit"] = page_size
+        params["offset"] = offset
+        if attrs is not None:
+            params["attrs"] = attrs
+        if options is not None:
+            params["options"] = options
+        response = self.send_get(f"{self.endpoint}/entities", params)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Query failed with response code {response.status_code}: {response.text}")
+        return response.json()
 
-    def get_all_entities(self, type=None):
+    def iter_entity_pages(self, type=None, page_size=1000, **query):
         """
-        Gets all entities of a given type (if type provided)
+        Yields the pages of the entities of a given type (if type provided) matching
+        the query (see get_entities_page) one after another.
         """
-        call_endpoint = f"{self.endpoint}/entities?"
-        if type is not None:
-            call_endpoint += "type=" + type + "&limit=1000&offset="
-        else:
-            call_endpoint += "limit=1000&offset="
         offset = 0
-        call_endpoint_base = call_endpoint
-        final_response = []
         while True:
-            call_endpoint = call_endpoint_base + str(offset)
-            response = self.send_get(call_endpoint)
-            response_json = response.json()
-            if len(response_json) == 0:
+            page = self.get_entities_page(type, offset, page_size, **query)
+            if page:
+                yield page
+            if len(page) < page_size:
                 break
-            for value in response_json:
-                final_response.append(value)
-            offset += 1000
-        return final_response
+            offset += page_size
+
+    def iter_all_entities(self, type=None, page_size=1000, **query):
+        """
+        Yields all entities of a given type (if type provided) matching the query
+        (see get_entities_page) page by page, without keeping them in memory.
+        """
+        for page in self.iter_entity_pages(type, page_size, **query):
+            yield from page
+
+    def get_all_entities(self, type=None, **filters):
+        """
+        Gets all entities of a given type (if type provided) matching the filters
+        (see get_query_params)
+        """
+        return list(self.iter_all_entities(type, **filters))
+
+    def count_entities(self, type=None, **filters):
+        """
+        Counts the entities of a given type (if type provided) matching the filters
+        (see get_query_params) without fetching them.
+        """
+        params = self.get_query_params(type, **filters)
+        params.update({"limit": 1, "options": "count"})
+        response = self.send_get(f"{self.endpoint}/entities", params)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Query failed with response code {response.status_code}: {response.text}")
+        return int(response.headers["Fiware-Total-Count"])
     
-    def delete_all_entities(self, type=None):
+    def get_entity(self, entity_id, type=None, options=None):
+        """
+        Gets a single entity by id (None if it does not exist).
+        """
+        params = {key: value for key, value in {"type": type, "options": options}.items() if value is not None}
+        response = self.send_get(f"{self.endpoint}/entities/{entity_id}", params)
+        if response.status_code == 404:
+            return None
+        if response.status_code >= 400:
+            raise RuntimeError(f"Query failed with response code {response.status_code}: {response.text}")
+        return response.json()
+
+    def get_entity_types(self, page_size=1000):
+        """
+        Gets all entity types of the service with their number of entities and the names
+        and types of their attributes from /v2/types. Orion answers this from its type
+        index, so even large services need only one request per page_size types.
+
+        Returns:
+            List of {"type": ..., "count": ..., "attrs": {name: {"types": [...]}}} dicts
+        """
+        call_endpoint = f"{self.endpoint}/types"
+        types = []
+        offset = 0
+        while True:
+            response = self.send_get(call_endpoint, {"options": "count", "limit": page_size, "offset": offset})
+            if response.status_code >= 400:
+                raise RuntimeError(f"Query failed with response code {response.status_code}: {response.text}")
+            types.extend(response.json())
+            offset += page_size
+            if offset >= int(response.headers.get("Fiware-Total-Count", 0)):
+                break
+        return types
+
+    def create_subscription(self, notify_url, types=None, attrs=None, description=None, expires=None, throttling=None):
+        """
+        Creates a subscription that makes Orion POST the changed entities to notify_url.
+
+        Args:
+            notify_url: URL of the notification receiver (must be reachable from Orion)
+            types: Entity types to watch (all entities if None)
+            attrs: Attributes whose changes trigger a notification and which are sent (all if None)
+            description: Description of the subscription
+            expires: datetime after which Orion removes the subscription
+            throttling: Minimum number of seconds between two notifications
+
+        Returns:
+            Id of the subscription
         """
-        Gets all entities of a given type (if type provided)
+        entities = [{"idPattern": ".*", "type": type} for type in types] if types else [{"idPattern": ".*"}]
+        subscription = {
+            "description": description or "fiware-admin change feed",
+            "subject": {"entities": entities, "condition": {"attrs": list(attrs or [])}},
+            "notification": {"http": {"url": notify_url}, "attrs": list(attrs or []), "attrsFormat": "normalized"},
+        }
+        if expires is not None:
+            subscription["expires"] = expires.strftime("%Y-%m-%dT%H:%M:%S.000Z")
+        if throttling is not None:
+            subscription["throttling"] = throttling
+        response = self.send_post(f"{self.endpoint}/subscriptions", body = subscription)
+        if response.status_code >= 400:
+            raise RuntimeError(f"Creating the subscription failed with response code {response.status_code}: {response.text}")
+        return response.headers["Location"].rstrip("/").split("/")[-1]
+
+    def delete_subscription(self, subscription_id):
+        """
+        Deletes a subscription.
+        """
+        response = self.send_delete(f"{self.endpoint}/subscriptions/{subscription_id}")
+        if response.status_code >= 400:
+            print(f"Error: {response.text}")
+            print(f"Response code: {response.status_code}")
+        return response
+
+    def delete_all_entities(self, type=None, **filters):
+        """
+        Deletes all entities of a given type (if type provided) matching the filters
+        (see get_query_params)
         """
         call_endpoint = f"{self.endpoint}/op/update"
         # First query all entities to get their IDs
-        result = self.get_all_entities(type)
+        result = self.get_all_entities(type, **filters)
         ids = []
         for entity in result:
             ids.append(
@@ -110,16 +292,19 @@ class FiwareClient():
 
         return result
     
-    def upload_entities(self, entities, key_values = False):
+    def upload_entities(self, entities, key_values = False, mode = "append_strict"):
         """
         Uploads entities to the Fiware instance.
+        @param mode: actionType of the update, one of UPLOAD_MODES.
         """
+        if mode not in UPLOAD_MODES:
+            raise ValueError(f"Unknown upload mode {mode}, expected one of {', '.join(UPLOAD_MODES)}")
         call_endpoint = f"{self.endpoint}/op/update"
         if key_values:
             call_endpoint += "?options=keyValues"
         
         payload = {
-            "actionType": "append_strict",
+            "actionType": mode,
             "entities": entities
         }
         response = self.send_post(call_endpoint, body = payload)
@@ -128,6 +313,69 @@ class FiwareClient():
             print(f"Response code: {response.status_code}")
         return response
     
+    def get_failed_entity_ids(self, response, entities):
+        """
+        Returns the ids of the entities of a batch which Orion lists in the error description
+        of a partial failure, e.g. "Already Exists: [ E1, E2 ]" or "do not exist: E1 - [ A1 ]".
+        """
+        try:
+            description = response.json().get("description", "")
+        except ValueError:
+            description = response.text
+        tokens = {token.split("::")[-1] for token in re.split(r"[\s\[\],]+", description)}
+        return {entity["id"] for entity in entities if entity["id"] in tokens}
+
+    def upload_entities_with_recovery(self, entities, key_values=False, dead_letters=None, mode="append_strict"):
+        """
+        Uploads entities and, if the batch is rejected as a whole (400, 413), splits it in
+        halves recursively until the offending entities are isolated. The parts without bad
+        entities are re-sent, so k bad entities out of n cost O(k log n) extra requests.
+        A partial failure (422, e.g. entities that already exist with append_strict) is not
+        split, because the other entities were stored: only the entities listed in the error
+        are rejected, or the whole batch if the error lists none of them. Other errors
+        (5xx, authorization, rate limits) reject the whole batch.
+
+        Args:
+            entities: List of entities to upload
+            key_values: Whether to use keyValues option
+            dead_letters: List the rejected entities are appended to as dead-letter records
+                          ({"entity": ..., "status": ..., "error": ...})
+            mode: actionType of the update, one of UPLOAD_MODES
+
+        Returns:
+            List of responses of all requests made
+        """
+        if dead_letters is None:
+            dead_letters = []
+        response = self.upload_entities(entities, key_values, mode)
+        if response.status_code < 400:
+            return [response]
+
+        if len(entities) == 1 or response.status_code not in BISECTABLE_STATUS_CODES:
+            rejected = entities
+            if response.status_code == PARTIAL_FAILURE_STATUS_CODE:
+                failed_ids = self.get_failed_entity_ids(response, entities)
+                if failed_ids:
+                    rejected = [entity for entity in entities if entity["id"] in failed_ids]
+            for entity in rejected:
+                dead_letters.append({"entity": entity, "status": response.status_code, "error": response.text})
+            return [response]
+
+        middle = len(entities) // 2
+        print(f"Batch with {len(entities)} entities rejected, retrying in two halves")
+        return ([response] + self.upload_entities_with_recovery(entities[:middle], key_values, dead_letters, mode)
+                + self.upload_entities_with_recovery(entities[middle:], key_values, dead_letters, mode))
+
+    def write_dead_letters(self, path, dead_letters, rejected=()):
+        """
+        Writes the entities rejected by the server (dead_letters) and by the validation
+        (rejected, (entity, problems) tuples) to a dead-letter file for later replay.
+        """
+        records = list(dead_letters) + [{"entity": entity, "status": None, "error": "; ".join(problems)}
+                                        for entity, problems in rejected]
+        write_entities(path, records)
+        print(f"Wrote {len(records)} rejected entities to {path}")
+
     def get_payload_size_bytes(self, entities):
         """
         Returns the total size of the payload with entities in bytes.
@@ -141,7 +389,7 @@ class FiwareClient():
         payload_json = json.dumps(payload)
         return len(payload_json.encode("utf-8"))
         
-    def upload_entities_with_size_check(self, entities, key_values = False, max_size_bytes = 1024 * 1024):
+    def upload_entities_with_size_check(self, entities, key_values = False, max_size_bytes = 1024 * 1024, mode = "append_strict"):
         """
         Uploads entities to the Fiware instance with a size check.
         Returns an error if entities exceed the max size.
@@ -150,6 +398,7 @@ class FiwareClient():
             entities: List of entities to upload
             key_values: Whether to use keyValues option
             max_size_bytes: Maximum size in bytes (default: 1MB)
+            mode: actionType of the update, one of UPLOAD_MODES
         """
         payload_size = self.get_payload_size_bytes(entities)
         if payload_size > max_size_bytes:
@@ -157,49 +406,142 @@ class FiwareClient():
             return {"error": "Payload too large", "size_kb": payload_size/1024}
         
         # Use the original upload_entities method
-        return self.upload_entities(entities, key_values)
+        return self.upload_entities(entities, key_values, mode)
         
-    def batch_and_upload_entities(self, entities, key_values=False, max_batch_size_bytes=1024*1024):
+    def validate_entities(self, entities, key_values=False, sanitize=False, max_entity_size_bytes=MAX_ENTITY_SIZE_BYTES,
+                          mode="append_strict"):
         """
-        Splits entities into batches and uploads each batch.
-        
+        Checks entities before uploading them and prints the problems of the rejected ones.
+
         Args:
-            entities: List of entities to upload
-            key_values: Whether to use keyValues option
-            max_batch_size_bytes: Maximum batch size in bytes (default: 1MB, must be lower then fiware maximum)
-        
+            entities: List (or any iterable) of entities
+            key_values: Whether the entities are in keyValues format
+            sanitize: Whether invalid ids, names and values are fixed instead of rejected
+            max_entity_size_bytes: Maximum size of a single entity in bytes
+            mode: actionType of the update, duplicate ids are only rejected for append_strict
+
         Returns:
-            List of responses from each batch upload
+            Tuple of the list of valid entities and the list of (entity, problems) tuples of the rejected ones
+        """
+        rejected = []
+        valid = list(iter_valid_entities(entities, rejected, sanitize, key_values, max_entity_size_bytes,
+                                         unique_ids=(mode == "append_strict")))
+        self.print_rejected_entities(rejected)
+        return valid, rejected
+
+    def print_rejected_entities(self, rejected):
+        """
+        Prints the entities rejected by the validation or the geometry compaction and why.
+        """
+        for entity, problems in rejected:
+            print(f"Rejected entity {entity.get('id')}: {'; '.join(problems)}")
+
+    def iter_entity_batches(self, entities, max_batch_size_bytes=1024*1024):
+        """
+        Groups entities into batches whose update payload stays below max_batch_size_bytes.
+        The payload size is accumulated entity by entity instead of serializing the whole
+        batch again for every added entity.
+
+        Yields:
+            Tuples of the batch (list of entities) and its payload size in bytes
         """
+        empty_size = self.get_payload_size_bytes([])
         batch = []
-        current_batch_size_bytes = 0
-        batch_number = 0
-        responses = []
-        
-        print(f"Total entities to upload: {len(entities)}")
-        
+        current_batch_size_bytes = empty_size
         for entity in entities:
-            # Calculate the new batch size if we add this entity
-            test_batch = batch + [entity]
-            new_batch_size = self.get_payload_size_bytes(test_batch)
-            
+            entity_size = len(json.dumps(entity).encode("utf-8"))
+            # Entities are separated by ", " in the payload
+            new_batch_size = current_batch_size_bytes + entity_size + (2 if batch else 0)
+
+            if not batch and new_batch_size > max_batch_size_bytes:
+                print(f"Warning: entity {entity.get('id')} alone exceeds the maximum batch size ({new_batch_size/1024:.2f} KB), consider compacting its geometry")
+
             if new_batch_size > max_batch_size_bytes and batch:
-                print(f"Uploading batch {batch_number + 1} with {len(batch)} entities ({current_batch_size_bytes/1024:.2f} KB)")
-                response = self.upload_entities(batch, key_values)
-                responses.append(response)
-                
-                # Reset for next batch
+                yield batch, current_batch_size_bytes
                 batch = [entity]
-                current_batch_size_bytes = self.get_payload_size_bytes(batch)
-                batch_number += 1
+                current_batch_size_bytes = empty_size + entity_size
             else:
                 batch.append(entity)
                 current_batch_size_bytes = new_batch_size
-        
-        # send last entities
         if batch:
-            print(f"Uploading final batch {batch_number + 1} with {len(batch)} entities ({current_batch_size_bytes/1024:.2f} KB)")
-            response = self.upload_entities(batch, key_values)
-            responses.append(response)
+            yield batch, current_batch_size_bytes
+
+    def upload_batch(self, batch, key_values=False, mode="append_strict", recover=False, dead_letters=None):
+        """
+        Uploads one batch, with bisecting recovery if recover is set (see upload_entities_with_recovery).
+
+        Returns:
+            List of responses
+        """
+        if recover:
+            return self.upload_entities_with_recovery(batch, key_values, dead_letters, mode)
+        return [self.upload_entities(batch, key_values, mode)]
+
+    def batch_and_upload_entities(self, entities, key_values=False, max_batch_size_bytes=1024*1024, compact_geometries=False,
+                                  validate=False, sanitize=False, recover=False, dead_letter_path=None, mode="append_strict",
+                                  stats=None):
+        """
+        Splits entities into batches and uploads each batch.
         
+        Args:
+            entities: List (or any iterable, e.g. a generator reading a file) of entities to upload
+            key_values: Whether to use keyValues option
+            max_batch_size_bytes: Maximum batch size in bytes (default: 1MB, must be lower then fiware maximum)
+            compact_geometries: Whether to simplify/split geo:json attributes of entities that would not fit into a batch on their own
+            validate: Whether to check the entities before uploading and skip invalid ones (see validation_helper)
+            sanitize: Whether to fix invalid ids, names and values instead of skipping the entities (implies validate)
+            recover: Whether rejected batches are split to isolate the bad entities and re-send the good ones
+            dead_letter_path: File the rejected entities are written to with their errors (implies recover)
+            mode: actionType of the updates, one of UPLOAD_MODES (append/update/replace overwrite existing entities in place)
+            stats: Dict which receives the number of uploaded entities, batches and failed batches
+                   (without recover), of entities rejected before the upload (rejected) and
+                   of entities rejected by the server (dead_letters)
+        
+        Returns:
+            List of responses from each batch upload
+        """
+        recover = recover or dead_letter_path is not None
+        dead_letters = []
+        rejected = []
+        if compact_geometries:
+            entities = compact_entities(entities, max_batch_size_bytes, split=True, rejected=rejected)
+        if validate or sanitize:
+            entities = iter_valid_entities(entities, rejected, sanitize, key_values, max_batch_size_bytes,
+                                           unique_ids=(mode == "append_strict"))
+
+        if stats is None:
+            stats = {}
+        stats.update({"entities": 0, "batches": 0, "failed_batches": 0, "rejected": 0, "dead_letters": 0})
+        responses = []
+
+        if hasattr(entities, "__len__"):
+            print(f"Total entities to upload: {len(entities)}")
+
+        def upload(batch, batch_size_bytes, label):
+            print(f"Uploading {label}{stats['batches'] + 1} with {len(batch)} entities ({batch_size_bytes/1024:.2f} KB)")
+            batch_responses = self.upload_batch(batch, key_values, mode, recover, dead_letters)
+            responses.extend(batch_responses)
+            stats["entities"] += len(batch)
+            stats["batches"] += 1
+            if not recover and batch_responses[-1].status_code >= 400:
+                stats["failed_batches"] += 1
+
+        # Look one batch ahead to know which batch is the last one
+        pending = None
+        for batch, batch_size_bytes in self.iter_entity_batches(entities, max_batch_size_bytes):
+            if pending is not None:
+                upload(*pending, "batch ")
+            pending = (batch, batch_size_bytes)
+
+        # send last entities
+        if pending is not None:
+            upload(*pending, "final batch ")
+
+        self.print_rejected_entities(rejected)
+        stats["rejected"] = len(rejected)
+        stats["dead_letters"] = len(dead_letters)
+        if recover:
+            print(f"{len(dead_letters)} entities rejected by the server")
+        if dead_letter_path is not None:
+            self.write_dead_letters(dead_letter_path, dead_letters, rejected)
         return responses
\ No newline at end of file
@@ -0,0 +1,135 @@
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+PAGE_SIZE = 1000
+FETCH_WORKERS = 1
+UPLOAD_WORKERS = 4
+# Number of fetched pages that may wait for the uploader
+QUEUE_PAGES = 4
+
+
+def iter_source_pages(source, type=None, page_size=PAGE_SIZE, fetch_workers=FETCH_WORKERS, **filters):
+    """
+    Yields the pages of the entities to copy in order. With more than one fetch worker
+    the number of entities is counted first and up to fetch_workers pages are fetched
+    concurrently by offset. Sharded sources are read one instance after another.
+    """
+    if fetch_workers <= 1 or not hasattr(source, "get_entities_page"):
+        yield from source.iter_entity_pages(type, page_size, **filters)
+        return
+
+    total = source.count_entities(type, **filters)
+    offsets = iter(range(0, total, page_size))
+    with ThreadPoolExecutor(max_workers=fetch_workers) as executor:
+        futures = deque()
+        for offset in offsets:
+            futures.append(executor.submit(source.get_entities_page, type, offset, page_size, **filters))
+            if len(futures) >= fetch_workers:
+                break
+        while futures:
+            page = futures.popleft().result()
+            offset = next(offsets, None)
+            if offset is not None:
+                futures.append(executor.submit(source.get_entities_page, type, offset, page_size, **filters))
+            if page:
+                yield page
+
+
+def prefetch(pages, queue_size=QUEUE_PAGES):
+    """
+    Fetches pages in a background thread into a bounded queue and yields them, so the
+    next page is fetched while the previous one is uploaded.
+    """
+    pages_queue = queue.Queue(maxsize=queue_size)
+    done = object()
+
+    def fetch():
+        try:
+            for page in pages:
+                pages_queue.put(page)
+        except Exception as e:
+            pages_queue.put(e)
+        pages_queue.put(done)
+
+    threading.Thread(target=fetch, daemon=True).start()
+    while True:
+        page = pages_queue.get()
+        if page is done:
+            return
+        if isinstance(page, Exception):
+            raise page
+        yield page
+
+
+def copy_entities(source, destination, type=None, mode="append", max_batch_size_bytes=1024*1024, page_size=PAGE_SIZE,
+                  fetch_workers=FETCH_WORKERS, upload_workers=UPLOAD_WORKERS, recover=False, dead_letter_path=None, **filters):
+    """
+    Copies entities from one FiwareClient (instance and service) to another. Pages are
+    fetched in the background into a bounded queue, packed into size-limited batches and
+    uploaded by upload_workers threads, at most two batches per worker are in flight.
+
+    Args:
+        source: FiwareClient to copy from
+        destination: FiwareClient to copy to
+        type: Only copy entities of this type
+        mode: actionType of the uploads (see client.UPLOAD_MODES)
+        max_batch_size_bytes: Maximum batch size in bytes
+        page_size: Number of entities fetched per request
+        fetch_workers: Number of pages fetched concurrently
+        upload_workers: Number of batches uploaded concurrently
+        recover: Whether rejected batches are split to isolate the bad entities
+        dead_letter_path: File the rejected entities are written to (implies recover)
+        filters: Query filters for the source (see FiwareClient.get_query_params)
+
+    Returns:
+        Dict with the number of copied entities, batches and rejected entities
+    """
+    start_time = time.time()
+    recover = recover or dead_letter_path is not None
+    dead_letters = []
+    in_flight = threading.BoundedSemaphore(2 * upload_workers)
+    lock = threading.Lock()
+    stats = {"fetched": 0, "copied": 0, "batches": 0, "failed_batches": 0}
+
+    def upload(batch):
+        try:
+            batch_dead_letters = []
+            responses = destination.upload_batch(batch, mode=mode, recover=recover, dead_letters=batch_dead_letters)
+            with lock:
+                stats["batches"] += 1
+                dead_letters.extend(batch_dead_letters)
+                if recover:
+                    stats["copied"] += len(batch) - len(batch_dead_letters)
+                elif responses[-1].status_code < 400:
+                    stats["copied"] += len(batch)
+                else:
+                    stats["failed_batches"] += 1
+        finally:
+            in_flight.release()
+
+    def iter_fetched_entities():
+        for page in prefetch(iter_source_pages(source, type, page_size, fetch_workers, **filters)):
+            stats["fetched"] += len(page)
+            yield from page
+
+    with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+        futures = []
+        for batch, _ in destination.iter_entity_batches(iter_fetched_entities(), max_batch_size_bytes):
+            in_flight.acquire()
+            futures.append(executor.submit(upload, batch))
+            if len(futures) % 10 == 0:
+                print(f"Copied {stats['copied']} of {stats['fetched']} fetched entities...")
+        for future in futures:
+            future.result()
+
+    if dead_letter_path is not None:
+        destination.write_dead_letters(dead_letter_path, dead_letters)
+    elapsed = time.time() - start_time
+    print(f"Copied {stats['copied']} of {stats['fetched']} entities in {stats['batches']} batches "
+          f"({stats['failed_batches']} failed, {len(dead_letters)} rejected) in {elapsed:.2f} s "
+          f"({stats['copied'] / max(elapsed, 1e-9):.0f} entities/s)")
+    return {"copied": stats["copied"], "fetched": stats["fetched"], "batches": stats["batches"],
+            "failed_batches": stats["failed_batches"], "rejected": len(dead_letters)}
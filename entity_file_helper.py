@@ -0,0 +1,99 @@
+import gzip
+import io
+import json
+
+# Entity files ending in .ndjson (optionally followed by .gz or .zst) hold one minified
+# entity per line. All other files are read and written as a JSON array of entities.
+NDJSON_EXTENSIONS = (".ndjson", ".ndjson.gz", ".ndjson.zst", ".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+def is_ndjson(path):
+    """
+    Returns whether the path names a (possibly compressed) NDJSON entity file.
+    """
+    return str(path).lower().endswith(NDJSON_EXTENSIONS)
+
+
+def open_entity_file(path, mode="r"):
+    """
+    Opens an entity file in text mode, (de)compressing it on the fly if the path ends in
+    .gz (gzip) or .zst (zstandard, requires the zstandard package).
+    """
+    path = str(path)
+    if path.lower().endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    if path.lower().endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading or writing .zst files requires the zstandard package (pip install zstandard)")
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True, closefd=True)
+        else:
+            # Appending adds a new frame, which is read back as part of the same stream
+            stream = zstandard.ZstdCompressor().stream_writer(open(path, mode + "b"), closefd=True)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+def write_entities(path, entities, indent=4):
+    """
+    Writes entities to a file. NDJSON files get one minified entity per line, other files
+    a JSON array indented by indent spaces. entities may be any iterable, e.g. a generator.
+
+    Returns:
+        Number of entities written
+    """
+    count = 0
+    with open_entity_file(path, "w") as f:
+        if is_ndjson(path):
+            for entity in entities:
+                f.write(json.dumps(entity, ensure_ascii=False, separators=(",", ":")))
+                f.write("\n")
+                count += 1
+        else:
+            entities = list(entities)
+            json.dump(entities, f, indent=indent, ensure_ascii=False)
+            count = len(entities)
+    return count
+
+
+def append_entities(path, entities):
+    """
+    Appends entities to an NDJSON file (created if it does not exist).
+
+    Returns:
+        Number of entities written
+    """
+    if not is_ndjson(path):
+        raise ValueError(f"Entities can only be appended to NDJSON files ({', '.join(NDJSON_EXTENSIONS)}), not to {path}")
+    count = 0
+    with open_entity_file(path, "a") as f:
+        for entity in entities:
+            f.write(json.dumps(entity, ensure_ascii=False, separators=(",", ":")))
+            f.write("\n")
+            count += 1
+    return count
+
+
+def iter_entities_from_file(path):
+    """
+    Yields the entities stored in a file. NDJSON files are read line by line,
+    JSON arrays are loaded at once.
+    """
+    with open_entity_file(path, "r") as f:
+        if is_ndjson(path):
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from json.load(f)
+
+
+def iter_dead_letter_entities(path):
+    """
+    Yields the entities of a dead-letter file written by FiwareClient.write_dead_letters.
+    """
+    for record in iter_entities_from_file(path):
+        yield record["entity"]
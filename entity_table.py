@@ -0,0 +1,165 @@
+# Compact container for large numbers of fetched entities. Instead of one nested dict per
+# entity (which repeats every attribute name, attribute type and empty metadata dict), the
+# attribute values are stored column by column: numbers in typed arrays, everything else in
+# plain lists. Entity and attribute types are interned, metadata is dropped.
+
+import array
+import json
+import math
+import sys
+import time
+
+# Largest integer a float column holds exactly, columns with larger integers stay lists
+MAX_EXACT_INTEGER = 2**53
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+
+def is_parquet(path):
+    """
+    Returns whether the path names a Parquet file.
+    """
+    return str(path).lower().endswith(PARQUET_EXTENSIONS)
+
+
+def is_float_value(value):
+    """
+    Returns whether a value can be stored in a float column without losing information.
+    """
+    if isinstance(value, float):
+        return True
+    return isinstance(value, int) and not isinstance(value, bool) and abs(value) <= MAX_EXACT_INTEGER
+
+
+class EntityTable():
+    """
+    Columnar table of entities with the columns id, type and one column per attribute.
+    Attributes holding only numbers are stored as array('d') (missing values are NaN)
+    with a flag per row telling whether the value was an integer, all others as lists
+    (missing values are None). Structured values (objects and lists, e.g. GeoJSON
+    locations) are stored as their JSON text.
+    """
+    def __init__(self) -> None:
+        self.ids = []
+        self.types = []
+        self.columns = {}
+        # Per float column: array('b') with 1 for the rows whose value was an integer
+        self.integer_flags = {}
+        # NGSI type of every attribute (the first one seen), e.g. Number or DateTime
+        self.attribute_types = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_column(self, name):
+        """
+        Returns the column of an attribute, created (filled with missing values) if necessary.
+        """
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns[name] = array.array("d", [math.nan]) * len(self.ids)
+            self.integer_flags[name] = array.array("b", [0]) * len(self.ids)
+        return column
+
+    def set_value(self, name, row, value):
+        """
+        Stores the value of an attribute in a row. A float column which gets a value other
+        than a number is converted into a list, integers are restored from their flags.
+        """
+        column = self.get_column(name)
+        if isinstance(value, (dict, list)):
+            value = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        if isinstance(column, array.array):
+            if is_float_value(value):
+                column[row] = value
+                self.integer_flags[name][row] = isinstance(value, int)
+                return
+            flags = self.integer_flags.pop(name)
+            column = self.columns[name] = [None if math.isnan(item) else int(item) if is_integer else item
+                                           for item, is_integer in zip(column, flags)]
+        column[row] = value
+
+    def append_entities(self, entities):
+        """
+        Appends entities (normalized or keyValues format), e.g. a page of a query.
+        """
+        for entity in entities:
+            row = len(self.ids)
+            self.ids.append(entity["id"])
+            self.types.append(sys.intern(entity["type"]))
+            for column in self.columns.values():
+                column.append(math.nan if isinstance(column, array.array) else None)
+            for flags in self.integer_flags.values():
+                flags.append(0)
+            for name, attribute in entity.items():
+                if name in ("id", "type"):
+                    continue
+                if isinstance(attribute, dict) and "value" in attribute:
+                    if name not in self.attribute_types and "type" in attribute:
+                        self.attribute_types[sys.intern(name)] = sys.intern(attribute["type"])
+                    attribute = attribute["value"]
+                if attribute is not None:
+                    self.set_value(sys.intern(name), row, attribute)
+
+    def to_dataframe(self):
+        """
+        Returns the table as a pandas DataFrame. Float columns are read from the arrays
+        without converting the values into Python objects (as nullable Int64 if all values
+        were integers), the type column is categorical and attributes of type DateTime are
+        converted to timestamps.
+        """
+        import numpy as np
+        import pandas as pd
+
+        data = {"id": self.ids, "type": pd.Categorical(self.types)}
+        for name, column in self.columns.items():
+            if isinstance(column, array.array):
+                values = np.frombuffer(column, dtype=np.float64)
+                is_integer = np.frombuffer(self.integer_flags[name], dtype=np.int8).astype(bool)
+                if is_integer.any() and (is_integer | np.isnan(values)).all():
+                    data[name] = pd.array(values, dtype="Int64")
+                else:
+                    data[name] = values
+            elif self.attribute_types.get(name) == "DateTime":
+                data[name] = pd.to_datetime(column, utc=True, errors="coerce", format="ISO8601")
+            else:
+                data[name] = column
+        return pd.DataFrame(data)
+
+    def to_parquet(self, path, **kwargs):
+        """
+        Writes the table to a Parquet file (requires pyarrow or fastparquet), e.g. for
+        analysis with pandas, DuckDB or Spark. Columns mixing strings and other values
+        are written as strings.
+        """
+        df = self.to_dataframe()
+        for name in self.columns:
+            if df[name].dtype == object and df[name].dropna().map(type).nunique() > 1:
+                df[name] = df[name].map(lambda value: value if value is None else str(value))
+        try:
+            df.to_parquet(path, index=False, **kwargs)
+        except ImportError:
+            raise ImportError("Writing Parquet files requires the pyarrow package (pip install pyarrow)")
+        return len(df)
+
+
+def fetch_entity_table(client, type=None, page_size=1000, **query):
+    """
+    Fetches entities page by page directly into an EntityTable, so only one page of
+    entity dicts is in memory at a time.
+
+    Args:
+        client: FiwareClient (or ShardedFiwareClient) of the service
+        type: Only fetch entities of this type
+        page_size: Number of entities fetched per request
+        query: Query parameters (see FiwareClient.get_entities_page), e.g. attrs or q
+
+    Returns:
+        EntityTable with the fetched entities
+    """
+    start_time = time.time()
+    table = EntityTable()
+    for page in client.iter_entity_pages(type, page_size, **query):
+        table.append_entities(page)
+    print(f"Fetched {len(table)} entities into a table with {len(table.columns)} attributes "
+          f"({time.time() - start_time:.2f} s)")
+    return table
@@ -2,13 +2,23 @@ import requests
 import os
 import sys
 import pandas as pd
-import json
 from shapely.geometry import shape
 from shapely.geometry import Polygon
 import numpy as np
 import re
+import argparse
+import time
 from shapely.geometry import Polygon
 from datetime import datetime
+from itertools import islice
+import shapely
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from mapping_helper import iter_entities, xy_point_locations
+from entity_file_helper import write_entities
+from client import create_session
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 # --- Setup paths ---
@@ -18,6 +28,151 @@ os.makedirs(DATA_DIR, exist_ok=True)
 
 # --- API configuration ---
 BASE_URL = "https://gis.lfrz.gv.at/api/geodata/i009501/ogc/features/v1/collections"
+PAGE_LIMIT = 1000
+FETCH_WORKERS = 8
+# Failed page requests are retried, a page that still fails aborts the run
+FETCH_RETRIES = 3
+RETRY_BACKOFF_SECONDS = 2
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+CONVERSION_BATCH_SIZE = 50000
+
+FIELD_USE_DICT = {
+    "ACKERLAND": "farmland",
+    "WEINGARTENFLÄCHEN IM ERTRAG INKL. JUNGANLAGEN UND SCHNITTWEINGÄRTEN": "wineyard",
+    "GRÜNLAND": "grassland",
+}
+# Funding ids of organisations a to e, and land uses, in the order of their one-hot attributes
+FUNDING_IDS = [1693, 1696, 1742, 1783, 1822]
+LAND_USES = ["farmland", "wineyard", "grassland"]
+
+# Bounding boxes (min lon, min lat, max lon, max lat) of the regions that can be requested by name
+REGIONS = {
+    "Austria": (9.53357, 46.40749, 17.16639, 49.01875),
+    "Vienna": (16.18183, 48.11834, 16.57761, 48.32264),
+}
+TILE_SIZE = 0.25
+
+# Output formats: indented JSON array or one minified entity per line (optionally compressed)
+OUTPUT_FORMATS = ["json", "ndjson", "ndjson.gz", "ndjson.zst"]
+
+def fetch_page(session, url, params=None, retries=FETCH_RETRIES):
+    """
+    Fetch a single page of an OGC API Features collection. Connection errors, timeouts,
+    server errors and rate limits are retried with exponential backoff, other errors and
+    the last failed attempt raise.
+    """
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, params=params, headers={"Accept": "application/geo+json"}, timeout=120)
+            if response.status_code not in RETRY_STATUS_CODES:
+                response.raise_for_status()
+                return response.json()
+            error = requests.HTTPError(f"Response code {response.status_code} for url: {response.url}", response=response)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            error = e
+        if attempt < retries:
+            delay = RETRY_BACKOFF_SECONDS * 2 ** attempt
+            print(f"Fetching {url} failed ({error}), retrying in {delay} s")
+            time.sleep(delay)
+    raise error
+
+def get_next_link(page):
+    """Return the URL of the next page of an OGC API Features response (None on the last page)."""
+    for link in page.get("links", []):
+        if link.get("rel") == "next":
+            return link.get("href")
+    return None
+
+def get_remaining_page_params(page, params, limit=PAGE_LIMIT):
+    """
+    If the server reports the total number of features and pages with offsets, return the
+    query parameters of all remaining pages so that they can be fetched concurrently.
+    Otherwise return None and the pages have to be fetched by following the next links.
+    """
+    number_matched = page.get("numberMatched")
+    next_link = get_next_link(page)
+    if number_matched is None or next_link is None or "offset=" not in next_link:
+        return None
+    return [{**params, "limit": limit, "offset": offset} for offset in range(limit, number_matched, limit)]
+
+def split_bbox(bbox, tile_size=TILE_SIZE):
+    """
+    Split a bounding box (min lon, min lat, max lon, max lat) into tiles of at most
+    tile_size degrees in each direction.
+    """
+    min_x, min_y, max_x, max_y = bbox
+    x_edges = np.append(np.arange(min_x, max_x, tile_size), max_x)
+    y_edges = np.append(np.arange(min_y, max_y, tile_size), max_y)
+    return [
+        (round(x0, 6), round(y0, 6), round(x1, 6), round(y1, 6))
+        for x0, x1 in zip(x_edges[:-1].tolist(), x_edges[1:].tolist())
+        for y0, y1 in zip(y_edges[:-1].tolist(), y_edges[1:].tolist())
+    ]
+
+def iter_features(collections, limit=PAGE_LIMIT, max_workers=FETCH_WORKERS, params=None, bboxes=None):
+    """
+    Yield the features of all given collections, fetching collections and pages concurrently
+    with a bounded number of workers. Features are yielded as soon as their page arrives,
+    so the order of features is not preserved. At most 2 * max_workers pages are fetched
+    ahead of the consumer.
+    If a list of bounding boxes (tiles) is given, each collection is queried once per tile
+    through the bbox parameter, and features crossing tile borders are only yielded once.
+    """
+    params = params or {}
+    if bboxes is None:
+        requests_params = [params]
+    else:
+        requests_params = [{**params, "bbox": ",".join(str(value) for value in bbox)} for bbox in bboxes]
+    seen_ids = set()
+
+    # At most this many pages are requested or wait to be consumed at any time, so the
+    # fetched pages cannot pile up while the consumer converts a batch
+    max_in_flight = 2 * max_workers
+    with create_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Each request is tagged with its collection, its query parameters and how it was
+        # requested: "first" page, one of the "offset" pages, or by following a "next" link.
+        # Requests wait in the queue until there is room for them.
+        queued = deque(
+            (f"{BASE_URL}/{collection}/items", {**request_params, "limit": limit}, (collection, request_params, "first"))
+            for collection in collections for request_params in requests_params
+        )
+        pending = {}
+
+        feature_count = 0
+        while pending or queued:
+            while queued and len(pending) < max_in_flight:
+                url, page_params, tag = queued.popleft()
+                pending[executor.submit(fetch_page, session, url, page_params)] = tag
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                collection, request_params, mode = pending.pop(future)
+                try:
+                    page = future.result()
+                except (requests.RequestException, ValueError) as e:
+                    # A missing page would also lose all pages after it, do not continue with a partial dataset
+                    for other in pending:
+                        other.cancel()
+                    raise RuntimeError(f"Fetching features for collection {collection} failed: {e}") from e
+
+                features = page.get("features", [])
+                feature_count += len(features)
+                print(f"{collection}: received {len(features)} features ({feature_count} in total)")
+                if bboxes is None:
+                    yield from features
+                else:
+                    for feature in features:
+                        feature_id = (collection, feature.get("properties", {}).get("gml_id", feature.get("id")))
+                        if feature_id not in seen_ids:
+                            seen_ids.add(feature_id)
+                            yield feature
+
+                remaining = get_remaining_page_params(page, request_params, limit) if mode == "first" else None
+                next_link = get_next_link(page)
+                if remaining is not None:
+                    url = f"{BASE_URL}/{collection}/items"
+                    queued.extend((url, page_params, (collection, request_params, "offset")) for page_params in remaining)
+                elif mode != "offset" and next_link is not None and features:
+                    queued.append((next_link, None, (collection, request_params, "next")))
 
 def create_general_attribute(type, value):
     """Create a new attribute for the entity."""
@@ -82,12 +237,7 @@ def create_id(field_use, field_parcel_id, date, id_choice):
 
 def translate_land_use(field_use):
     """Translate land use code to English."""
-    field_use_dict = {
-        "ACKERLAND": "farmland",
-        "WEINGARTENFLÄCHEN IM ERTRAG INKL. JUNGANLAGEN UND SCHNITTWEINGÄRTEN": "wineyard",
-        "GRÜNLAND": "grassland",
-    }
-    return field_use_dict.get(field_use)
+    return FIELD_USE_DICT.get(field_use)
 
 def categorize_funding(funding):
     organisation_a = 0
@@ -174,10 +324,126 @@ def convert_to_fiware_entity(feature, id_choice):
 
     return entity
 
-def convert_to_fiware_json(id_choice):
-    # Convert and save as FIWARE NGSI-v2
-    fiware_entities = []
+def compute_centroids(geometries):
+    """
+    Compute the location coordinates of a batch of GeoJSON geometries with vectorized
+    shapely operations. Points are taken as they are, polygons are reduced to the
+    centroid of their exterior ring (as in create_location).
+    Returns two numpy arrays with the x and y coordinates.
+    """
+    x = np.empty(len(geometries))
+    y = np.empty(len(geometries))
+    point_positions = []
+    point_coordinates = []
+    polygon_positions = []
+    ring_coordinates = []
+    ring_lengths = []
+    for position, geometry in enumerate(geometries):
+        if geometry["type"] == "Point":
+            point_positions.append(position)
+            point_coordinates.append(geometry["coordinates"][:2])
+        elif geometry["type"] == "Polygon":
+            ring = geometry["coordinates"][0]
+            polygon_positions.append(position)
+            ring_coordinates.extend(coordinate[:2] for coordinate in ring)
+            ring_lengths.append(len(ring))
+        else:
+            raise ValueError("Unsupported geometry type")
+
+    if point_positions:
+        point_coordinates = np.asarray(point_coordinates, dtype=float)
+        x[point_positions] = point_coordinates[:, 0]
+        y[point_positions] = point_coordinates[:, 1]
+    if polygon_positions:
+        ring_indices = np.repeat(np.arange(len(ring_lengths)), ring_lengths)
+        rings = shapely.linearrings(np.asarray(ring_coordinates, dtype=float), indices=ring_indices)
+        centroids = shapely.centroid(shapely.polygons(rings))
+        x[polygon_positions] = shapely.get_x(centroids)
+        y[polygon_positions] = shapely.get_y(centroids)
+
+    return x, y
+
+ORGANISATION_COLUMNS = ["organisation_a", "organisation_b", "organisation_c", "organisation_d", "organisation_e"]
+
+def measurands(columns):
+    """Transform that builds the measurand list of every parcel."""
+    return [
+        [f"length, {length}, GQ, Length", f"area, {area}, GQ, Area"]
+        for length, area in zip(columns["gml_length"].tolist(), columns["fs_flaeche_ha"].tolist())
+    ]
+
+# Mapping of the parcel columns to the attributes of a LandParcel entity (see mapping_helper)
+PARCEL_SCHEMA = {
+    "fart_id": {"name": "funding", "type": "Text"},
+    "fs_kennung": {"name": "field_parcel_id", "type": "Number"},
+    "dateObserved": {"name": "dateObserved", "type": "DateTime"},
+    "location": {"name": "location", "type": "geo:json", "source": ["x", "y"], "transform": xy_point_locations},
+    "area": {"name": "area", "type": "Number"},
+    "gml_length": {"name": "length", "type": "Number"},
+    "organisation_a": {"name": "oragnisation_a", "type": "Text"},
+    "organisation_b": {"name": "organisation_b", "type": "Text"},
+    "organisation_c": {"name": "organisation_c", "type": "Text"},
+    "organisation_d": {"name": "organisation_d", "type": "Text"},
+    "organisation_e": {"name": "organisation_e", "type": "Text"},
+    "farmland": {"name": "farmland", "type": "Text"},
+    "wineyard": {"name": "wineyard", "type": "Text"},
+    "grassland": {"name": "grassland", "type": "Text"},
+    "gml_id": {"name": "gml_id", "type": "Text"},
+    "measurand": {"name": "measurand", "type": "List", "source": ["gml_length", "fs_flaeche_ha"], "transform": measurands},
+}
+
+def convert_to_fiware_entities(features, id_choice):
+    """
+    Batched version of convert_to_fiware_entity: converts a list of features column-wise
+    and yields the resulting entities. Features without a known land use are skipped.
+    """
+    properties = pd.DataFrame.from_records([feature["properties"] for feature in features])
+    if properties.empty:
+        return
+    properties["field_use"] = properties["fnar_bezeichnung"].map(FIELD_USE_DICT)
+    keep = properties["field_use"].notna().to_numpy()
+    properties = properties[keep].reset_index(drop=True)
+    if properties.empty:
+        return
+    geometries = [feature.get("geometry", {}) for feature, kept in zip(features, keep) if kept]
+
+    date_observed = pd.Series([
+        datetime.fromisoformat(date).replace(tzinfo=None).isoformat()
+        for date in properties["geom_date_created"]
+    ])
+    if id_choice == 1:
+        ids = "LandParcel-" + properties["field_use"] + "-" + date_observed
+    elif id_choice == 2:
+        ids = "LandParcel-" + date_observed
+    else:
+        ids = "LandParcel-" + properties["fs_kennung"].astype(str)
+
+    x, y = compute_centroids(geometries)
+    properties["id"] = ids
+    properties["dateObserved"] = date_observed
+    properties["x"] = x
+    properties["y"] = y
+    properties["area"] = (properties["fs_flaeche_ha"].to_numpy() * 100).astype(int)
+    organisations = properties["fart_id"].to_numpy()[:, None] == np.array(FUNDING_IDS)
+    uses = properties["field_use"].to_numpy()[:, None] == np.array(LAND_USES)
+    for i, column in enumerate(ORGANISATION_COLUMNS):
+        properties[column] = organisations[:, i].astype(int)
+    for i, column in enumerate(LAND_USES):
+        properties[column] = uses[:, i].astype(int)
+
+    yield from iter_entities(properties, "LandParcel", PARCEL_SCHEMA, metadata=True)
+
+def iter_batches(iterable, batch_size=CONVERSION_BATCH_SIZE):
+    """Split an iterable into lists of at most batch_size elements."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            return
+        yield batch
 
+def convert_to_fiware_json(id_choice, bbox=None, tile_size=TILE_SIZE, output_format="json"):
+    # Convert and save as FIWARE NGSI-v2
     # fetch all feldstuecke collections
     collections = []
     # Send a GET request to the API
@@ -193,38 +459,56 @@ def convert_to_fiware_json(id_choice):
         ]
 
     else:
-        print(f"Failed to retrieve collections. Status code: {response.status_code}")
-
-    for collection in collections:
-        collection_url = f"{BASE_URL}/{collection}/items"
-        response = requests.get(collection_url, params={"limit": 1000})
-        features = response.json()
-
-        if "features" in features:
-            for feature in features["features"]:
-                entity = convert_to_fiware_entity(feature, id_choice)
-                if entity is None:
-                    continue
-                fiware_entities.append(entity)
-        else:
-            print(f"Error fetching features for collection {collection}: {features}")
+        raise RuntimeError(f"Failed to retrieve collections. Status code: {response.status_code}")
+
+    bboxes = None
+    if bbox is not None:
+        bboxes = split_bbox(bbox, tile_size)
+        print(f"Fetching features in {len(bboxes)} tiles of bounding box {bbox}")
 
-    # Save FIWARE-compatible JSON
-    fiware_path = os.path.join(DATA_DIR, 'fiware_data.json')
-    with open(fiware_path, 'w', encoding='utf-8') as f:
-        json.dump(fiware_entities, f, ensure_ascii=False, indent=2)
+    fiware_entities = (
+        entity
+        for features in iter_batches(iter_features(collections, bboxes=bboxes))
+        for entity in convert_to_fiware_entities(features, id_choice)
+    )
 
-    print(f"Saved FIWARE-compatible entities to {fiware_path}")
+    # Save FIWARE-compatible JSON (NDJSON is written while the features are streamed in)
+    # The file is written under a temporary name and only renamed once all pages were fetched
+    fiware_path = os.path.join(DATA_DIR, f'fiware_data.{output_format}')
+    tmp_path = os.path.join(DATA_DIR, f'fiware_data.part.{output_format}')
+    try:
+        count = write_entities(tmp_path, fiware_entities, indent=2)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, fiware_path)
+
+    print(f"Saved {count} FIWARE-compatible entities to {fiware_path}")
 
 if __name__ == "__main__":
     
     # Validate arguments given
-    if not isinstance(sys.argv[1],int) or sys.argv[1] > 3 or len(sys.argv) < 2:
-        print(f'Usage: python process_data.py <ID-Choice>')
-        print("Please enter an integer between 1 and 3")
-        print(f'Enter a number as one of your choices \n 1 to categorize data points by their land use \n 2 to categorize them all in one category \n 3 to visualize each point independently')
-        sys.exit(1)
+    arg_parser = argparse.ArgumentParser(description='Converts the INVEKOS field parcels of Austria to FIWARE entities.')
+    arg_parser.add_argument('id_choice', type=int, choices=[1, 2, 3],
+                            help='1 to categorize data points by their land use, 2 to categorize them all in one category, '
+                                 '3 to visualize each point independently')
+    arg_parser.add_argument('--area', choices=sorted(REGIONS),
+                            help='Only fetch the parcels in the bounding box of the given region.')
+    arg_parser.add_argument('--bbox', metavar='<min_lon,min_lat,max_lon,max_lat>',
+                            help='Only fetch the parcels in the given bounding box.')
+    arg_parser.add_argument('--tile-size', type=float, default=TILE_SIZE,
+                            help=f'Size of the tiles (in degrees) the bounding box is split into (default {TILE_SIZE})')
+    arg_parser.add_argument('--format', choices=OUTPUT_FORMATS, default='json',
+                            help='Format of the entity file (default json)')
+    args = arg_parser.parse_args()
 
-    id_choice = sys.argv[1]
-    
-    convert_to_fiware_json(id_choice)
\ No newline at end of file
+    bbox = None
+    if args.bbox:
+        bbox = tuple(float(value) for value in args.bbox.split(','))
+        if len(bbox) != 4:
+            arg_parser.error('--bbox expects four comma separated values')
+    elif args.area:
+        bbox = REGIONS[args.area]
+
+    convert_to_fiware_json(args.id_choice, bbox, args.tile_size, args.format)
@@ -5,15 +5,25 @@ import os
 import re
 import sys
 import unicodedata
-import datetime
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, '..', '..'))
+from entity_file_helper import write_entities, iter_entities_from_file
+from client import create_session
 
-metadata = pd.read_csv(os.path.join(CURR_DIR, 'metadata.csv'))
+# Output formats: indented JSON array or one minified entity per line (optionally compressed)
+OUTPUT_FORMATS = ["json", "ndjson", "ndjson.gz", "ndjson.zst"]
+
+METADATA_PATH = os.path.join(CURR_DIR, 'metadata.csv')
 
 DATA_DIR = os.path.join(CURR_DIR, 'data')
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
+
+STATION_INDEX_PATH = os.path.join(DATA_DIR, 'station_index.parquet')
     
 POLLUTANT_MAP = {
     1: "SO2",
@@ -38,45 +48,112 @@ POLLUTANT_DESCRIPTION  = {
     "PM2.5": "Particulate Matter 2.5μm"
 }
 
-def download_files_and_merge_in_one_file(parquet_files, output_path, raw_dir):
+DOWNLOAD_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+def download_file(session, url, local_path, chunk_size=DOWNLOAD_CHUNK_SIZE):
     """
-    Download parquet files from the given URLs and merge them into a single DataFrame with daily aggregation.
+    Stream a single file to disk in chunks. The data is written to a temporary
+    '.part' file which is renamed to local_path once the download is complete,
+    so an interrupted download never leaves a truncated file behind.
+    Returns the number of bytes written.
     """
-    dataframes = []
-
+    tmp_path = local_path + '.part'
+    size = 0
+    try:
+        with session.get(url, stream=True, timeout=60) as response:
+            response.raise_for_status()
+            with open(tmp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    f.write(chunk)
+                    size += len(chunk)
+        os.replace(tmp_path, local_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return size
+
+def download_files(parquet_files, raw_dir, max_workers=DOWNLOAD_WORKERS):
+    """
+    Download the given URLs into raw_dir using a bounded pool of worker threads.
+    Files which already exist locally are skipped.
+    Returns the list of local paths that are available after the download.
+    """
+    local_paths = []
+    pending = {}
     for url in parquet_files:
         file_name = url.split('/')[-1]
         local_path = os.path.join(raw_dir, file_name)
-
-        if not os.path.exists(local_path):
-            print(f"Downloading {file_name} from {url}")
-            response = requests.get(url)
-            if response.status_code == 200:
-                with open(local_path, 'wb') as f:
-                    f.write(response.content)
-                print(f"Downloaded {file_name}")
-            else:
-                print(f"Failed to download {file_name}")
-                continue
-        else:
+        if os.path.exists(local_path):
             print(f"{file_name} already exists locally, skipping.")
+            local_paths.append(local_path)
+        else:
+            pending[url] = local_path
+
+    if not pending:
+        return local_paths
+
+    print(f"Downloading {len(pending)} files with {max_workers} workers")
+    start = time.perf_counter()
+    total_bytes = 0
+    done = 0
+    with create_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(download_file, session, url, local_path): (url, local_path)
+            for url, local_path in pending.items()
+        }
+        for future in as_completed(futures):
+            url, local_path = futures[future]
+            file_name = os.path.basename(local_path)
+            done += 1
+            try:
+                total_bytes += future.result()
+            except (requests.RequestException, OSError) as e:
+                print(f"[{done}/{len(pending)}] Failed to download {file_name}: {e}")
+                continue
+            local_paths.append(local_path)
+            elapsed = time.perf_counter() - start
+            print(f"[{done}/{len(pending)}] Downloaded {file_name} "
+                  f"({total_bytes / 1024 / 1024:.1f} MB, {total_bytes / 1024 / 1024 / elapsed:.2f} MB/s)")
 
-        df = pd.read_parquet(local_path)
-        dataframes.append(df)
+    elapsed = time.perf_counter() - start
+    print(f"Downloaded {total_bytes / 1024 / 1024:.1f} MB in {elapsed:.1f} s")
+    return local_paths
 
-    merged_df = pd.concat(dataframes, ignore_index=True)
-    merged_df.drop(columns=[
-        'End', 'AggType', 'Validity', 'Verification', 'ResultTime',
-        'DataCapture', 'FkObservationLog'
-    ], inplace=True, errors='ignore')
+RAW_COLUMNS = ['Samplingpoint', 'Pollutant', 'Start', 'Value', 'Unit']
+PARTIAL_KEYS = ['Samplingpoint', 'Date', 'Pollutant', 'Unit']
 
-    merged_df['Unit'] = merged_df['Unit'].str.replace('ug.m-3', 'ug/m3')
-    merged_df['Start'] = pd.to_datetime(merged_df['Start'])
-    merged_df['Date'] = merged_df['Start'].dt.floor('d')
-    merged_df['Samplingpoint'] = merged_df['Samplingpoint'].str.replace('AT/', '')
+def aggregate_parquet_file(local_path):
+    """
+    Read only the needed columns of a raw parquet file and reduce its hourly rows to
+    partial daily sums and counts per (Samplingpoint, Date, Pollutant, Unit).
+    """
+    df = pd.read_parquet(local_path, columns=RAW_COLUMNS)
+    df['Date'] = pd.to_datetime(df['Start']).dt.floor('d')
 
-    metadata_df = clean_metadata(metadata)
-    df = merged_df.merge(metadata_df, on='Samplingpoint', how='left')
+    return df.groupby(PARTIAL_KEYS, as_index=False, observed=True).agg(
+        Sum=('Value', 'sum'),
+        Count=('Value', 'count')
+    )
+
+def combine_partial_aggregates(partials):
+    """
+    Combine partial daily aggregates computed for different files into one.
+    """
+    combined = pd.concat(partials, ignore_index=True)
+    return combined.groupby(PARTIAL_KEYS, as_index=False).agg({'Sum': 'sum', 'Count': 'sum'})
+
+def finalize_daily_aggregates(partial_df):
+    """
+    Attach station metadata to the combined partial aggregates and compute the daily
+    mean per station and pollutant.
+    """
+    df = partial_df.copy()
+    df['Unit'] = df['Unit'].str.replace('ug.m-3', 'ug/m3')
+    df['Samplingpoint'] = df['Samplingpoint'].str.replace('AT/', '')
+
+    station_index = get_station_index().drop(columns=['Slug'])
+    df = df.merge(station_index, on='Samplingpoint', how='left')
 
     df['PollutantName'] = df['Pollutant'].map(POLLUTANT_MAP)
     df['PollutantName'] = df['PollutantName'].fillna('Pollutant_' + df['Pollutant'].astype(str))
@@ -85,7 +162,23 @@ def download_files_and_merge_in_one_file(parquet_files, output_path, raw_dir):
     df = df.groupby([
         'StationName', 'Date', 'Pollutant', 'Unit', 'Lon', 'Lat',
         'Municipality', 'StationArea', 'StationType'
-    ], as_index=False).agg({'Value': 'mean'})
+    ], as_index=False).agg({'Sum': 'sum', 'Count': 'sum'})
+    df['Value'] = df['Sum'] / df['Count']
+
+    return df.drop(columns=['Sum', 'Count'])
+
+def download_files_and_merge_in_one_file(parquet_files, output_path, raw_dir):
+    """
+    Download parquet files from the given URLs and merge them into a single DataFrame with daily aggregation.
+    The files are aggregated one at a time, so memory scales with the number of
+    stations and days rather than with the number of raw hourly rows.
+    """
+    partials = []
+
+    for local_path in download_files(parquet_files, raw_dir):
+        partials.append(aggregate_parquet_file(local_path))
+
+    df = finalize_daily_aggregates(combine_partial_aggregates(partials))
 
     df.to_parquet(output_path, index=False)
     
@@ -98,8 +191,113 @@ def download_files_and_merge_in_one_file(parquet_files, output_path, raw_dir):
             os.remove(local_path)
             print(f"Deleted {file_name}")
   
+def fetch_file_info(parquet_files, max_workers=DOWNLOAD_WORKERS):
+    """
+    Send a HEAD request for every URL and collect its ETag, size and modification date.
+    URLs whose HEAD request fails are mapped to None.
+    """
+    def head(session, url):
+        response = session.head(url, allow_redirects=True, timeout=60)
+        response.raise_for_status()
+        return {
+            "etag": response.headers.get('ETag'),
+            "size": response.headers.get('Content-Length'),
+            "last_modified": response.headers.get('Last-Modified')
+        }
+
+    file_info = {}
+    with create_session(max_workers) as session, ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(head, session, url): url for url in parquet_files}
+        for future in as_completed(futures):
+            url = futures[future]
+            try:
+                file_info[url] = future.result()
+            except requests.RequestException as e:
+                print(f"Could not check {url}: {e}")
+                file_info[url] = None
+    return file_info
+
+def load_manifest(manifest_path):
+    """
+    Load the manifest of already ingested parquet URLs (empty if it does not exist yet).
+    """
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+def save_manifest(manifest_path, manifest):
+    """
+    Write the manifest of ingested parquet URLs atomically.
+    """
+    tmp_path = manifest_path + '.part'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=4)
+    os.replace(tmp_path, manifest_path)
+
+def update_merged_file_incrementally(parquet_files, city_dir, raw_dir):
+    """
+    Download only the parquet files which are new or changed since the last run
+    (according to the manifest in city_dir), merge their daily aggregates into the
+    merged dataset and return an iterable of the AirQualityObserved entities affected by them.
+
+    The per-file partial aggregates are kept in daily_aggregates.parquet, so that the
+    contribution of a changed file can be replaced instead of added twice.
+    """
+    manifest_path = os.path.join(city_dir, 'manifest.json')
+    aggregates_path = os.path.join(city_dir, 'daily_aggregates.parquet')
+    merged_file_path = os.path.join(city_dir, 'merged_data.parquet')
+
+    manifest = load_manifest(manifest_path)
+    if not os.path.exists(aggregates_path):
+        manifest = {}
+
+    file_info = fetch_file_info(parquet_files)
+    changed = [url for url in parquet_files if file_info[url] is None or manifest.get(url) != file_info[url]]
+    print(f"{len(changed)} of {len(parquet_files)} files are new or changed")
+    if not changed:
+        return []
+
+    for url in changed:
+        local_path = os.path.join(raw_dir, url.split('/')[-1])
+        if os.path.exists(local_path):
+            os.remove(local_path)
+
+    partials = []
+    for local_path in download_files(changed, raw_dir):
+        partials.append(aggregate_parquet_file(local_path).assign(Source=os.path.basename(local_path)))
+        os.remove(local_path)
+    if not partials:
+        return []
+    new_aggregates = pd.concat(partials, ignore_index=True)
+    sources = set(new_aggregates['Source'])
+
+    if os.path.exists(aggregates_path):
+        aggregates = pd.read_parquet(aggregates_path)
+        replaced = aggregates['Source'].isin(sources)
+        affected_aggregates = pd.concat([aggregates[replaced], new_aggregates], ignore_index=True)
+        aggregates = pd.concat([aggregates[~replaced], new_aggregates], ignore_index=True)
+    else:
+        affected_aggregates = new_aggregates
+        aggregates = new_aggregates
+
+    df = finalize_daily_aggregates(combine_partial_aggregates([aggregates]))
+    affected = finalize_daily_aggregates(combine_partial_aggregates([affected_aggregates]))
+    affected = affected[['StationName', 'Date']].drop_duplicates()
+
+    aggregates.to_parquet(aggregates_path, index=False)
+    df.to_parquet(merged_file_path, index=False)
+    print(f"Merged DataFrame saved to {merged_file_path}")
+
+    for url in changed:
+        if url.split('/')[-1] in sources:
+            manifest[url] = file_info[url]
+    save_manifest(manifest_path, manifest)
+
+    return iter_fiware_entities(df.merge(affected, on=['StationName', 'Date']))
+
 def clean_metadata(met_df):
-    met_df.rename(columns={
+    met_df = met_df.rename(columns={
     'Sampling Point Id': 'Samplingpoint',
     'Air Quality Station Name': 'StationName',
     'Longitude': 'Lon',
@@ -107,53 +305,115 @@ def clean_metadata(met_df):
     'Municipality': 'Municipality',
     'Air Quality Station Area': 'StationArea',
     'Air Quality Station Type': 'StationType'
-    }, inplace=True)
+    })
     
     met_df = met_df[['Samplingpoint', 'StationName', 'Lon', 'Lat', 'Municipality', 'StationArea', 'StationType']]
     
     return met_df
 
+def build_station_index(metadata_path=METADATA_PATH, index_path=STATION_INDEX_PATH):
+    """
+    Build the station index from the metadata CSV: the cleaned metadata columns with one
+    row per sampling point and the precomputed id slug of every station name.
+    The index is stored as a parquet file next to the downloaded data.
+    """
+    station_index = clean_metadata(pd.read_csv(metadata_path)).drop_duplicates().reset_index(drop=True)
+    slugs = {name: slugify_station_name(name) for name in station_index['StationName'].dropna().unique()}
+    station_index['Slug'] = station_index['StationName'].map(slugs)
 
+    # Per-process temporary file, several worker processes may build the index at the same time
+    tmp_path = f"{index_path}.{os.getpid()}.part"
+    station_index.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, index_path)
+    return station_index
 
-def generate_entity_id(station_name: str, date: datetime) -> str:
-    # remove umlauts/accents
-    normalized = unicodedata.normalize("NFKD", station_name)
-    ascii_only = normalized.encode("ascii", "ignore").decode("ascii")
-
-    slug = re.sub(r"[^a-zA-Z0-9]+", "-", ascii_only).strip("-")
+_station_index = None
 
-    date_str = date.strftime("%Y-%m-%dT%H:%M:%S")
+def get_station_index():
+    """
+    Return the station index, loading it from the cache file if it is newer than the
+    metadata CSV and rebuilding it otherwise. The index is loaded once per process.
+    """
+    global _station_index
+    if _station_index is None:
+        if os.path.exists(STATION_INDEX_PATH) and os.path.getmtime(STATION_INDEX_PATH) >= os.path.getmtime(METADATA_PATH):
+            _station_index = pd.read_parquet(STATION_INDEX_PATH)
+        else:
+            print(f"Building station index {STATION_INDEX_PATH}")
+            _station_index = build_station_index()
+    return _station_index
 
-    return f"AT-AirQualityObserved-{slug}-{date_str}"
+def get_station_slugs():
+    """
+    Return a mapping of station name to the slug used in entity ids.
+    """
+    station_index = get_station_index().dropna(subset=['StationName'])
+    return dict(zip(station_index['StationName'], station_index['Slug']))
 
 
 
-def convert_to_fiware_json(df_path):
-    
-    
-    df = pd.read_parquet(df_path)
-    unique_station_names = []
-    
-    entities = []
+ENTITY_KEYS = ['StationName', 'Date', 'Lon', 'Lat', 'Municipality', 'StationArea']
 
-    # Group by StationName + Date to aggregate pollutants across sampling points
-    grouped = df.groupby([
-        'StationName', 'Date', 'Lon', 'Lat', 'Municipality', 'StationArea'
-    ])
-    
+def slugify_station_name(station_name: str) -> str:
+    # remove umlauts/accents
+    normalized = unicodedata.normalize("NFKD", station_name)
+    ascii_only = normalized.encode("ascii", "ignore").decode("ascii")
 
-    for (station_name, date, lon, lat, municipality, area), group in grouped:
-        
-        if not station_name in unique_station_names:
-            unique_station_names.append(station_name)
+    return re.sub(r"[^a-zA-Z0-9]+", "-", ascii_only).strip("-")
 
-        
+def build_entity_columns(df):
+    """
+    Compute the per-entity and per-measurement columns of the FIWARE entities with
+    vectorized operations.
+    Returns a DataFrame with one row per entity (StationName + Date) and a DataFrame
+    with one row per pollutant measurement, both ordered by entity number.
+    """
+    df = df.dropna(subset=ENTITY_KEYS)
+    df = df.assign(EntityNumber=df.groupby(ENTITY_KEYS, sort=True).ngroup())
+    df = df.sort_values('EntityNumber', kind='stable')
+
+    groups = df.drop_duplicates('EntityNumber')[ENTITY_KEYS + ['EntityNumber']].reset_index(drop=True)
+    slugs = get_station_slugs()
+    slugs.update({name: slugify_station_name(name) for name in groups['StationName'].unique() if name not in slugs})
+    groups['Id'] = ('AT-AirQualityObserved-' + groups['StationName'].map(slugs) + '-'
+                    + groups['Date'].dt.strftime('%Y-%m-%dT%H:%M:%S'))
+    groups['DateObserved'] = groups['Date'].dt.strftime('%Y-%m-%dT00:00:00Z')
+    groups['Lon'] = groups['Lon'].round(6)
+    groups['Lat'] = groups['Lat'].round(6)
+
+    measurements = df[df['Pollutant'].isin(POLLUTANT_DESCRIPTION.keys())]
+    measurements = measurements[['EntityNumber', 'Pollutant']].assign(Value=measurements['Value'].round(2))
+    # Formatted like str(float) independent of the pandas version (a missing value becomes "nan")
+    measurements['Measurand'] = [
+        f"{pollutant},{value},GQ,{POLLUTANT_DESCRIPTION[pollutant]}"
+        for pollutant, value in zip(measurements['Pollutant'].tolist(), measurements['Value'].tolist())
+    ]
+
+    return groups, measurements.reset_index(drop=True)
+
+def iter_fiware_entities(df):
+    """
+    Yield the AirQualityObserved entities for a merged DataFrame one at a time.
+    """
+    groups, measurements = build_entity_columns(df)
+
+    entity_numbers = measurements['EntityNumber'].tolist()
+    pollutants = measurements['Pollutant'].tolist()
+    values = measurements['Value'].tolist()
+    measurands = measurements['Measurand'].tolist()
+    position = 0
+
+    for entity_number, entity_id, date_observed, station_name, lon, lat, municipality, area in zip(
+        groups['EntityNumber'].tolist(), groups['Id'].tolist(), groups['DateObserved'].tolist(),
+        groups['StationName'].tolist(), groups['Lon'].tolist(), groups['Lat'].tolist(),
+        groups['Municipality'].tolist(), groups['StationArea'].tolist()
+    ):
         entity = {
-            "id": generate_entity_id(station_name, date),
+            "id": entity_id,
             "type": "AirQualityObserved",
             "dateObserved": {
                 "type": "DateTime",
-                "value": date.strftime('%Y-%m-%dT00:00:00Z'),
+                "value": date_observed,
                 "metadata": {}
             },
             "stationName": {
@@ -165,7 +425,7 @@ def convert_to_fiware_json(df_path):
                 "type": "geo:json",
                 "value": {
                     "type": "Point",
-                    "coordinates": [round(lon, 6), round(lat, 6)]
+                    "coordinates": [lon, lat]
                 },
                 "metadata": {}
             },
@@ -195,24 +455,28 @@ def convert_to_fiware_json(df_path):
             }
         }
 
-        for _, row in group.iterrows():
-            pollutant = row['Pollutant']
-            if pollutant not in POLLUTANT_DESCRIPTION:
-                continue
-            value = round(row['Value'], 2)
-            entity[pollutant] = {
+        while position < len(entity_numbers) and entity_numbers[position] == entity_number:
+            entity[pollutants[position]] = {
                 "type": "Number",
-                "value": value,
+                "value": values[position],
                 "metadata": {}
             }
-            measurand_str = f"{pollutant},{value},GQ,{POLLUTANT_DESCRIPTION[pollutant]}"
-            entity["measurand"]["value"].append(measurand_str)
+            entity["measurand"]["value"].append(measurands[position])
+            position += 1
 
-        entities.append(entity)
-    
+        yield entity
+
+def convert_to_fiware_json(df_path):
+    """
+    Return a generator of the AirQualityObserved entities of a merged parquet file, so the
+    entities can be written one at a time instead of being collected in a list.
+    """
+    df = pd.read_parquet(df_path)
+
+    unique_station_names = df.dropna(subset=ENTITY_KEYS)['StationName'].sort_values().unique().tolist()
     print(f"Unique station names: {unique_station_names}")
 
-    return entities
+    return iter_fiware_entities(df)
 
 def fetch_parquet_links(city_name: str) -> pd.DataFrame:
     """
@@ -253,40 +517,117 @@ def fetch_parquet_links(city_name: str) -> pd.DataFrame:
     return urls
 
 
-if __name__ == "__main__":
-    allowed_cities = {"Graz", "Linz", "Innsbruck", "Wien", "Klagenfurt", "Salzburg"}
+ALLOWED_CITIES = {"Graz", "Linz", "Innsbruck", "Wien", "Klagenfurt", "Salzburg"}
 
-    if len(sys.argv) < 2:
-        print('Usage: python script.py <CityName1> <CityName2> ...')
-        print(f"Allowed cities: {', '.join(allowed_cities)}")
-        sys.exit(1)
+def process_city(city_name, incremental=False, output_format="json"):
+    """
+    Run the fetch, merge and convert steps for a single city.
+    Returns the city name, the path of the entity file, the number of entities written
+    (None if skipped), the elapsed time in seconds and the status ("processed", "updated"
+    or "skipped" if the files of the city already existed).
+    """
+    start = time.perf_counter()
 
-    city_names = sys.argv[1:]
+    DATA_ROOT = os.path.join(CURR_DIR, 'data')
+    CITY_DIR = os.path.join(DATA_ROOT, city_name)
+    RAW_DIR = os.path.join(CITY_DIR, 'raw')
+    os.makedirs(RAW_DIR, exist_ok=True)
 
-    for city_name in city_names:
-        if city_name not in allowed_cities:
-            print(f"City '{city_name}' not recognized. Skipping. Choose from: {', '.join(allowed_cities)}")
-            continue
+    merged_file_path = os.path.join(CITY_DIR, 'merged_data.parquet')
+    fiware_file_path = os.path.join(CITY_DIR, f'fiware_data.{output_format}')
+
+    if incremental:
+        # Only new or changed source files are processed, the output contains the affected entities only
+        parquet_files = fetch_parquet_links(city_name)
+        entities = update_merged_file_incrementally(parquet_files, CITY_DIR, RAW_DIR)
+        update_file_path = os.path.join(CITY_DIR, f'fiware_update.{output_format}')
+        count = write_entities(update_file_path, entities)
+        print(f"Saved {count} updated entities to {update_file_path}")
+        print(f"Incremental processing for '{city_name}' completed.\n")
+        return city_name, update_file_path, count, time.perf_counter() - start, "updated"
+
+    if os.path.exists(merged_file_path) and os.path.exists(fiware_file_path):
+        print(f"Files for '{city_name}' already exist. Skipping download and processing.")
+        return city_name, fiware_file_path, None, time.perf_counter() - start, "skipped"
 
-        DATA_ROOT = os.path.join(CURR_DIR, 'data')
-        CITY_DIR = os.path.join(DATA_ROOT, city_name)
-        RAW_DIR = os.path.join(CITY_DIR, 'raw')
-        os.makedirs(RAW_DIR, exist_ok=True)
+    parquet_files = fetch_parquet_links(city_name)
 
-        merged_file_path = os.path.join(CITY_DIR, 'merged_data.parquet')
-        fiware_file_path = os.path.join(CITY_DIR, 'fiware_data.json')
+    if not os.path.exists(merged_file_path):
+        download_files_and_merge_in_one_file(parquet_files, merged_file_path, RAW_DIR)
 
-        if os.path.exists(merged_file_path) and os.path.exists(fiware_file_path):
-            print(f"Files for '{city_name}' already exist. Skipping download and processing.")
+    entities = convert_to_fiware_json(merged_file_path)
+    count = write_entities(fiware_file_path, entities)
+
+    print(f"Processing for '{city_name}' completed.\n")
+    return city_name, fiware_file_path, count, time.perf_counter() - start, "processed"
+
+def process_cities(city_names, incremental=False, max_workers=None, output_format="json"):
+    """
+    Process several cities in parallel, one worker process per city.
+    Returns the results of process_city in the order the cities were given.
+    """
+    max_workers = max_workers or len(city_names)
+    # Build the station index once before the workers load it
+    get_station_index()
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(process_city, city_name, incremental, output_format): city_name for city_name in city_names}
+        for future in as_completed(futures):
+            city_name = futures[future]
+            try:
+                results[city_name] = future.result()
+            except Exception as e:
+                print(f"Processing for '{city_name}' failed: {e}")
+                results[city_name] = (city_name, None, 0, None, "failed")
+    return [results[city_name] for city_name in city_names]
+
+def combine_entity_files(file_paths, output_path):
+    """
+    Combine the entity files written for several cities into a single file.
+    The format of the output is chosen by its extension (see entity_file_helper).
+    """
+    entities = (entity for file_path in file_paths for entity in iter_entities_from_file(file_path))
+    count = write_entities(output_path, entities)
+    print(f"Saved {count} entities of {len(file_paths)} cities to {output_path}")
+
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description='Downloads and converts the air quality data of Austrian cities to FIWARE entities.')
+    arg_parser.add_argument('cities', metavar='<CityName>', nargs='+',
+                            help=f"Cities to process. Allowed cities: {', '.join(sorted(ALLOWED_CITIES))}")
+    arg_parser.add_argument('--incremental', action='store_true',
+                            help='Only process new or changed source files and output the affected entities.')
+    arg_parser.add_argument('-w', '--workers', type=int, default=None,
+                            help='Number of cities processed in parallel (default: one process per city)')
+    arg_parser.add_argument('--combined', metavar='<json_file>',
+                            help='Additionally combine the entities of all cities into this file.')
+    arg_parser.add_argument('--format', choices=OUTPUT_FORMATS, default='json',
+                            help='Format of the entity files (default json)')
+    args = arg_parser.parse_args()
+
+    city_names = []
+    for city_name in args.cities:
+        if city_name not in ALLOWED_CITIES:
+            print(f"City '{city_name}' not recognized. Skipping. Choose from: {', '.join(ALLOWED_CITIES)}")
             continue
+        if city_name not in city_names:
+            city_names.append(city_name)
 
-        parquet_files = fetch_parquet_links(city_name)
+    if not city_names:
+        sys.exit(1)
 
-        if not os.path.exists(merged_file_path):
-            download_files_and_merge_in_one_file(parquet_files, merged_file_path, RAW_DIR)
+    start = time.perf_counter()
+    results = process_cities(city_names, args.incremental, args.workers, args.format)
 
-        entities = convert_to_fiware_json(merged_file_path)
-        with open(fiware_file_path, 'w') as f:
-            json.dump(entities, f, indent=4, ensure_ascii=False)
+    print('----------- Summary -----------')
+    for city_name, output_path, entity_count, elapsed, status in results:
+        if status == "failed":
+            print(f"{city_name}: failed")
+        elif status == "skipped":
+            print(f"{city_name}: skipped, using existing {output_path}")
+        else:
+            print(f"{city_name}: {entity_count} entities in {elapsed:.1f} s -> {output_path}")
+    print(f"Total time: {time.perf_counter() - start:.1f} s")
 
-        print(f"Processing for '{city_name}' completed.\n")
+    if args.combined:
+        combine_entity_files([output_path for _, output_path, _, _, status in results if status != "failed"], args.combined)
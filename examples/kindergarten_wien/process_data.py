@@ -1,21 +1,33 @@
 import pandas as pd
-import json
+import numpy as np
 import os
-import re
+import sys
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, '..', '..'))
+from mapping_helper import read_feature_columns, xy_point_locations, iter_entities
+from entity_file_helper import write_entities
+
+capacity_columns = [
+    "FAMILIE_0_6", "FAMILIE_3_10",
+    "HEILPAED_HORT_6_10", "HEILPAED_KDG_3_6",
+    "HORT_6_10", "INTEGRAT_FAMILIE_0_6",
+    "INTEGRAT_FAMILIE_3_10", "INTEGRAT_HORT_6_10",
+    "INTEGRAT_KDG_3_6", "INTEGRAT_KLEINKINDER_0_3",
+    "KDG_3_6", "HALBTAGS_KDG_3_6",
+    "KLEINKINDER_0_3"
+]
+properties = ["TYP_TXT", "BETREIBER", "BEZEICHNUNG", "ADRESSE", "TXTATT1", "WEBLINK1", "KONTAKT"] + capacity_columns
 
 print("\nTransforming kindergarten data to FIWARE format:")
 print("-> Opening raw data file...")
-with open(os.path.join(CURR_DIR, 'kindergarten_wien_raw_data.json'), 'r', encoding="utf-8") as f:
-    data = json.load(f)
-df = pd.DataFrame(data['features'])
+df = read_feature_columns(os.path.join(CURR_DIR, 'kindergarten_wien_raw_data.json'), properties)
 # print(df.head())
 
 # --- Preprocessing: Filter by TYP_TXT value counts ---
 print("-> Preprocessing: Filtering by TYP_TXT value counts...")
 # Extract the 'TYP_TXT' series
-typ_txt_series = df['properties'].apply(lambda x: x.get('TYP_TXT'))
+typ_txt_series = df['TYP_TXT']
 
 # Calculate value counts
 typ_txt_counts = typ_txt_series.value_counts()
@@ -24,9 +36,8 @@ typ_txt_counts = typ_txt_series.value_counts()
 valid_types = typ_txt_counts[typ_txt_counts > 20].index.tolist()
 
 # Filter the DataFrame
-df_filtered = df[df['properties'].apply(lambda x: x.get(
-    # Use .copy() to avoid SettingWithCopyWarning
-    'TYP_TXT') in valid_types)].copy()
+# Use .copy() to avoid SettingWithCopyWarning
+df_filtered = df[typ_txt_series.isin(valid_types)].copy()
 print(f"-> Original number of features: {len(df)}")
 print(
     f"-> Number of features after filtering by TYP_TXT counts (>15): {len(df_filtered)}")
@@ -34,89 +45,55 @@ print("-> Number of unique TYP_TXT values after filtering:", len(valid_types))
 # --- End of Preprocessing ---
 
 
-def clean_fiware_string(text_value):
-    if text_value is None or not isinstance(text_value, str):
-        return text_value  # Return as is if None or not a string
+FORBIDDEN_CHARS_PATTERN = r"""[<>"'=;()]"""
 
-    # Characters explicitly forbidden by FIWARE documentation
-    forbidden_chars = ['<', '>', '"', "'", '=', ';', '(', ')']
-    for char in forbidden_chars:
-        # Remove forbidden characters
-        text_value = text_value.replace(char, '')
 
-    # Replace multiple spaces with a single space and strip leading/trailing spaces
-    text_value = ' '.join(text_value.split()).strip()
+def clean_fiware_strings(series):
+    """
+    Removes the characters forbidden by FIWARE from the strings of a column and collapses
+    runs of whitespace into single spaces. Values which are not strings are kept as they are.
+    """
+    is_string = series.map(lambda value: isinstance(value, str))
+    cleaned = (series[is_string].astype(str)
+               .str.replace(FORBIDDEN_CHARS_PATTERN, '', regex=True)
+               .str.split().str.join(' '))
+    result = series.copy()
+    result[is_string] = cleaned
+    return result
 
-    return text_value
+
+def total_capacity(capacities):
+    total = capacities.apply(pd.to_numeric).fillna(0).sum(axis=1)
+    if (total % 1 == 0).all():
+        total = total.astype(np.int64)
+    return total
+
+
+schema = {
+    "location": {"name": "location", "type": "geo:json", "source": ["x", "y"], "transform": xy_point_locations},
+    "capacity": {"name": "capacity", "type": "Number", "source": capacity_columns, "transform": total_capacity},
+    "TYP_TXT": {"name": "kindergarten_type", "type": "Text",
+                "transform": lambda series: clean_fiware_strings(series.str.replace("<br>", " "))},
+    "BETREIBER": {"name": "operator", "type": "Text", "transform": clean_fiware_strings},
+    "BEZEICHNUNG": {"name": "name", "type": "Text", "transform": clean_fiware_strings},
+    "ADRESSE": {"name": "address", "type": "Text", "transform": clean_fiware_strings},
+    "TXTATT1": {"name": "availability", "type": "Text",
+                "transform": lambda series: pd.Series(np.where(series == "Privat", "Private", "Public"))},
+    # URLs might need specific URL encoding if they contain special chars
+    "WEBLINK1": {"name": "weblink", "type": "URL"},
+    "KONTAKT": {"name": "contact", "type": "Text", "transform": clean_fiware_strings},
+}
 
 
 def transform_to_fiware(df):
-    fiware_entities = []
-    for _, row in df.iterrows():
-        feature = row
-        entity_id = feature['id']
-        entity_type = 'Kindergarten'
-
-        # Geometry
-        coordinates = feature['geometry']['coordinates']
-        location = {
-            'type': 'geo:json',
-            'value': {
-                'type': 'Point',
-                'coordinates': coordinates
-            }
-        }
-
-        # Properties
-        properties = feature['properties']
-
-        capacity_columns = [
-            "FAMILIE_0_6", "FAMILIE_3_10",
-            "HEILPAED_HORT_6_10", "HEILPAED_KDG_3_6",
-            "HORT_6_10", "INTEGRAT_FAMILIE_0_6",
-            "INTEGRAT_FAMILIE_3_10", "INTEGRAT_HORT_6_10",
-            "INTEGRAT_KDG_3_6", "INTEGRAT_KLEINKINDER_0_3",
-            "KDG_3_6", "HALBTAGS_KDG_3_6",
-            "KLEINKINDER_0_3"
-        ]
-
-        total_capacity = 0
-        for column in capacity_columns:
-            if pd.notna(properties[column]) and properties[column] is not None:
-                total_capacity += properties[column]
-
-        kindergarten_type = clean_fiware_string(
-            properties["TYP_TXT"].replace("<br>", " "))
-        operator = clean_fiware_string(properties["BETREIBER"])
-        name = clean_fiware_string(properties["BEZEICHNUNG"])
-        adress = clean_fiware_string(properties["ADRESSE"])
-        availability = "Private" if properties["TXTATT1"] == "Privat" else "Public"
-        # URLs might need specific URL encoding if they contain special chars
-        weblink = properties["WEBLINK1"]
-        contact = clean_fiware_string(properties["KONTAKT"])
-
-        entity = {
-            'id': entity_id,
-            'type': entity_type,
-            'location': location,
-            'capacity': {'type': 'Number', 'value': total_capacity},
-            'kindergarten_type': {'type': 'Text', 'value': kindergarten_type},
-            'operator': {'type': 'Text', 'value': operator},
-            'name': {'type': 'Text', 'value': name},
-            'address': {'type': 'Text', 'value': adress},
-            'availability': {'type': 'Text', 'value': availability},
-            'weblink': {'type': 'URL', 'value': weblink},
-            'contact': {'type': 'Text', 'value': contact}
-        }
-
-        fiware_entities.append(entity)
-    return fiware_entities
+    return list(iter_entities(df, 'Kindergarten', schema))
 
 
 print("-> Transforming data to FIWARE format...")
 fiware_data = transform_to_fiware(df_filtered)
 
 print("-> Saving transformed data to file...")
-with open(os.path.join(CURR_DIR, 'kindergarten_wien_fiware.json'), 'w', encoding='utf-8') as f:
-    json.dump(fiware_data, f, ensure_ascii=False, indent=4)
+# The output file can be given as argument, e.g. kindergarten_wien_fiware.ndjson.gz for compact NDJSON
+output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(CURR_DIR, 'kindergarten_wien_fiware.json')
+write_entities(output_path, fiware_data)
 print("DONE.\n")
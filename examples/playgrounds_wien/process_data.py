@@ -1,70 +1,44 @@
-import pandas as pd
-import json
 import os
+import sys
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, '..', '..'))
+from mapping_helper import read_feature_columns, xy_point_locations, iter_entities
+from entity_file_helper import write_entities
 
 print("\nTransforming playground data to FIWARE format:")
 print("-> Opening raw data file...")
-with open(os.path.join(CURR_DIR, 'spielplatz_wien_raw_data.json'), 'r', encoding="utf-8") as f:
-    data = json.load(f)
-df = pd.DataFrame(data['features'])
+df = read_feature_columns(os.path.join(CURR_DIR, 'spielplatz_wien_raw_data.json'),
+                          ["ANL_NAME", "TYP_DETAIL", "SPIELPLATZ_DETAIL"])
+
+
+def unique_details(details_texts):
+    """
+    Sorted, de-duplicated list of the comma separated playground details.
+    """
+    details = details_texts.str.split(",").explode().str.strip()
+    details = details[details != ""].groupby(level=0).unique().map(sorted).str.join(", ")
+    return details.reindex(details_texts.index, fill_value="")
+
+
+# The entity type is reserved, so the type of the playground is stored as playgroundType
+schema = {
+    "location": {"name": "location", "type": "geo:json", "source": ["x", "y"], "transform": xy_point_locations},
+    "ANL_NAME": {"name": "name", "type": "Text"},
+    "TYP_DETAIL": {"name": "playgroundType", "type": "Text"},
+    "SPIELPLATZ_DETAIL": {"name": "details", "type": "Text", "transform": unique_details},
+}
 
 
 def transform_to_fiware(df):
-    fiware_entities = []
-    # spielplatz_details = {}
-    for _, row in df.iterrows():
-        feature = row
-        entity_id = feature['id']
-        entity_type = 'Playground'
+    return list(iter_entities(df, 'Playground', schema))
 
-        # Geometry
-        coordinates = feature['geometry']['coordinates']
-        location = {
-            'type': 'geo:json',
-            'value': {
-                'type': 'Point',
-                'coordinates': coordinates
-            }
-        }
-        
-        # Properies
-        properties = feature['properties']
-        name = properties["ANL_NAME"]
-        type = properties["TYP_DETAIL"]
-        details_text = properties["SPIELPLATZ_DETAIL"]
-        details = [detail.strip() for detail in details_text.split(",") if detail.strip()]
-        details = list(set(details))
-        details.sort()
-        
-        # Build entity
-        entity = {
-            'id': entity_id,
-            'type': entity_type,
-            'location': location,
-            'properties': {
-                'name': {'type': 'Text', 'value': name},
-                'type': {'type': 'Text', 'value': type},
-                'details': {'type': 'Text', 'value': ", ".join(details)},
-                # Add more properties as needed
-            }
-        }
-        
 
-        # for detail in row["properties"]["SPIELPLATZ_DETAIL"].split(","):
-        #     detail = detail.strip()
-        #     if not detail:
-        #         continue
-        #     if detail not in spielplatz_details:
-        #         spielplatz_details[detail] = 1
-        #     else:
-        #         spielplatz_details[detail] += 1
-                
-        
+print("-> Transforming data to FIWARE format...")
+fiware_data = transform_to_fiware(df)
 
-    # print("\nPlayground details:")
-    # for detail, count in spielplatz_details.items():
-    #     print(f"{detail}: {count}")
-        
-transform_to_fiware(df)
\ No newline at end of file
+print("-> Saving transformed data to JSON file...")
+# The output file can be given as argument, e.g. spielplatz_wien_fiware.ndjson.gz for compact NDJSON
+output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(CURR_DIR, 'spielplatz_wien_fiware.json')
+write_entities(output_path, fiware_data)
+print("DONE.\n")
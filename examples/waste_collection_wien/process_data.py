@@ -1,14 +1,19 @@
 import pandas as pd
-import json
+import numpy as np
 import os
+import sys
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, '..', '..'))
+from mapping_helper import read_feature_columns, xy_point_locations, iter_entities
+from entity_file_helper import write_entities
+
+properties = ['FRAKTION_PA', 'FRAKTION_BI', 'FRAKTION_DO', 'FRAKTION_G', 'FRAKTION_KV',
+              'BEZIRK', 'STRASSE', 'BEZUG', 'ONR', 'URL_TEXT']
 
 print("\nTransforming waste collection data to FIWARE format:")
 print("-> Opening raw data file...")
-with open(os.path.join(CURR_DIR, 'waste_collection_wien_raw_data.json'), 'r', encoding="utf-8") as f:
-    data = json.load(f)
-df = pd.DataFrame(data['features'])
+df = read_feature_columns(os.path.join(CURR_DIR, 'waste_collection_wien_raw_data.json'), properties)
 
 fractionMapDe = {
     'FRAKTION_PA': 'Altpapier',
@@ -26,64 +31,47 @@ fractionMapEn = {
 }
 
 
-def transform_to_fiware(df):
-    fiware_entities = []
-    for _, row in df.iterrows():
-        feature = row
-        entity_id = feature['id']
-        entity_type = 'WasteCollectionPoint'
+def fraction_names(fractions):
+    """
+    Comma separated, sorted English names of the fractions collected at each point.
+    """
+    text = pd.Series('', index=fractions.index)
+    for property, name in sorted(fractionMapEn.items(), key=lambda item: item[1]):
+        text = text + np.where(fractions[property].astype(bool), name + ', ', '')
+    return text.str.removesuffix(', ')
 
-        # Geometry
-        coordinates = feature['geometry']['coordinates']
-        location = {
-            'type': 'geo:json',
-            'value': {
-                'type': 'Point',
-                'coordinates': coordinates
-            }
-        }
 
-        # Properties
-        properties = feature['properties']
-        list_of_fraction_names = []
-        for property in ['FRAKTION_PA', 'FRAKTION_BI', 'FRAKTION_DO', 'FRAKTION_G', 'FRAKTION_KV']:
-            if properties[property]:
-                list_of_fraction_names.append(fractionMapEn[property])
+def to_bool(series):
+    return series.astype(bool)
 
-        # Handle FRAKTION
-        fraktion = {
-            'PA': {'type': 'Boolean', 'value': bool(properties['FRAKTION_PA'])},
-            'BI': {'type': 'Boolean', 'value': bool(properties['FRAKTION_BI'])},
-            'DO': {'type': 'Boolean', 'value': bool(properties['FRAKTION_DO'])},
-            'G': {'type': 'Boolean', 'value': bool(properties['FRAKTION_G'])},
-            'KV': {'type': 'Boolean', 'value': bool(properties['FRAKTION_KV'])},
-            'TEXT': {'type': 'Text', 'value': ", ".join(sorted(list_of_fraction_names))},
-        }
 
-        # Other properties
-        other_properties = {
-            'BEZIRK': {'type': 'Number', 'value': properties['BEZIRK']},
-            'STRASSE': {'type': 'Text', 'value': properties['STRASSE']},
-            'BEZUG': {'type': 'Text', 'value': properties['BEZUG']},
-            'ONR': {'type': 'Text', 'value': properties['ONR']},
-            'URL_TEXT': {'type': 'URL', 'value': properties['URL_TEXT']}
-        }
+schema = {
+    "location": {"name": "location", "type": "geo:json", "source": ["x", "y"], "transform": xy_point_locations},
+    # Handle FRAKTION
+    "FRAKTION_PA": {"name": "PA", "type": "Boolean", "transform": to_bool},
+    "FRAKTION_BI": {"name": "BI", "type": "Boolean", "transform": to_bool},
+    "FRAKTION_DO": {"name": "DO", "type": "Boolean", "transform": to_bool},
+    "FRAKTION_G": {"name": "G", "type": "Boolean", "transform": to_bool},
+    "FRAKTION_KV": {"name": "KV", "type": "Boolean", "transform": to_bool},
+    "TEXT": {"name": "TEXT", "type": "Text", "source": list(fractionMapEn), "transform": fraction_names},
+    # Other properties
+    "BEZIRK": {"name": "BEZIRK", "type": "Number"},
+    "STRASSE": {"name": "STRASSE", "type": "Text"},
+    "BEZUG": {"name": "BEZUG", "type": "Text"},
+    "ONR": {"name": "ONR", "type": "Text"},
+    "URL_TEXT": {"name": "URL_TEXT", "type": "URL"},
+}
 
-        entity = {
-            'id': entity_id,
-            'type': entity_type,
-            'location': location,
-            **fraktion,
-            **other_properties
-        }
-        fiware_entities.append(entity)
-    return fiware_entities
+
+def transform_to_fiware(df):
+    return list(iter_entities(df, 'WasteCollectionPoint', schema))
 
 
 print("-> Transforming data to FIWARE format...")
 fiware_data = transform_to_fiware(df)
 
 print("-> Saving transformed data to JSON file...")
-with open(CURR_DIR + "/" + 'waste_collection_wien_fiware.json', 'w', encoding="utf-8") as f:
-    json.dump(fiware_data, f, indent=4, ensure_ascii=False)
+# The output file can be given as argument, e.g. waste_collection_wien_fiware.ndjson.gz for compact NDJSON
+output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(CURR_DIR, 'waste_collection_wien_fiware.json')
+write_entities(output_path, fiware_data)
 print("DONE.\n")
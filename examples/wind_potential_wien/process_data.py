@@ -2,10 +2,20 @@
 import pandas as pd
 import json
 import os
+import sys
 import geopandas
 from shapely.geometry import shape, mapping
 
 CURR_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(CURR_DIR, '..', '..'))
+from geometry_helper import compact_entities
+from entity_file_helper import write_entities
+
+# Geometry compaction: simplification tolerance (degrees, 0 = only if needed), coordinate
+# decimals and whether too large MultiPolygons are split into one entity per polygon
+SIMPLIFY_TOLERANCE = 0
+COORDINATE_PRECISION = 6
+SPLIT_PARTS = False
 
 print("\nTransforming wind potential data to FIWARE format:")
 print("-> Opening raw data file...")
@@ -83,9 +93,14 @@ def transform_to_fiware(data):
 
 fiware_data = transform_to_fiware(data)
 
+print("-> Compacting geometries to fit the Orion request size limit...")
+fiware_data = compact_entities(fiware_data, tolerance=SIMPLIFY_TOLERANCE,
+                               precision=COORDINATE_PRECISION, split=SPLIT_PARTS)
+
 print("-> Saving transformed data to JSON file...")
-with open(CURR_DIR + "/" + 'wind_potential_wien_fiware.json', 'w', encoding="utf-8") as f:
-    json.dump(fiware_data, f, indent=4, ensure_ascii=False)
+# The output file can be given as argument, e.g. wind_potential_wien_fiware.ndjson.gz for compact NDJSON
+output_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(CURR_DIR, 'wind_potential_wien_fiware.json')
+write_entities(output_path, fiware_data)
 print("DONE.\n")
 
 # --- SOLUTION FOR SEPARATE POLYGONS ---
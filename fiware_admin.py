@@ -1,7 +1,17 @@
 import argparse
+import fnmatch
 import json
-from client import FiwareClient
+import time
+from concurrent.futures import ThreadPoolExecutor
+from client import FiwareClient, UPLOAD_MODES, create_session
+from sharded_client import ShardedFiwareClient
 from random_helper import generate_simple_time_series, time_series_to_json, add_metadata
+from entity_file_helper import iter_entities_from_file, iter_dead_letter_entities, write_entities
+from mirror_helper import refresh_mirror
+from notification_helper import run_change_feed
+from copy_helper import copy_entities
+from aggregate_helper import REDUCERS, CACHE_TTL_SECONDS, aggregate_panels, parse_ssd, get_reduce_panels
+from entity_table import fetch_entity_table, is_parquet
 
 version = "0.0.2"
 
@@ -15,6 +25,261 @@ def get_type(args):
         type = args.type
     return type
 
+def get_filters(args):
+    """
+    Returns the server-side query filters given on the command line.
+    """
+    return {
+        "q": args.q,
+        "mq": args.mq,
+        "georel": args.georel,
+        "geometry": args.geometry,
+        "coords": args.coords,
+        "id_pattern": args.id_pattern,
+        "order_by": args.order_by,
+    }
+
+def create_client(config, service, session=None):
+    """
+    Returns a client for a config: a ShardedFiwareClient if the config lists several
+    "endpoints", a FiwareClient for a single "endpoint" otherwise.
+    """
+    if "endpoints" in config:
+        return ShardedFiwareClient(config["endpoints"], config["token"], service, session)
+    return FiwareClient(config["endpoint"], config["token"], service, session)
+
+def get_services(service_arg, config):
+    """
+    Returns the services given with -s: a comma separated list of names and glob patterns
+    (e.g. "wien-*"), the patterns are matched against the "services" list of the config file.
+    """
+    if not service_arg:
+        return [""]
+    services = []
+    for name in service_arg.split(","):
+        name = name.strip()
+        if any(char in name for char in "*?["):
+            matches = fnmatch.filter(config.get("services", []), name)
+            if not matches:
+                print(f"Warning: no service in the config file matches {name}")
+            services.extend(matches)
+        else:
+            services.append(name)
+    # Keep the order but drop duplicates
+    return list(dict.fromkeys(services))
+
+def get_service_path(path, service):
+    """
+    Returns a file path for a service, {service} in the path is replaced with the service name.
+    """
+    if path is None:
+        return None
+    return path.replace("{service}", service or "default")
+
+def get_inventory(config, service, session=None):
+    """
+    Gets the entity types of a service (see FiwareClient.get_entity_types).
+
+    Returns:
+        Dict with the service, the entity types (None if the query failed), an error
+        message (None if the query succeeded) and the elapsed time
+    """
+    start_time = time.time()
+    types = None
+    error = None
+    try:
+        client = create_client(config, service, session)
+        types = client.get_entity_types()
+    except Exception as e:
+        error = str(e)
+        print(f"Error in inventory of service '{service}': {error}")
+    return {"service": service, "types": types, "error": error, "elapsed": time.time() - start_time}
+
+def add_inventory_reports(reports, inventories):
+    """
+    Adds the results and errors of the inventories to the reports of the services.
+    """
+    for inventory in inventories:
+        report = next((report for report in reports if report["service"] == inventory["service"]), None)
+        if report is None:
+            report = {"service": inventory["service"], "results": {}, "error": None, "elapsed": 0}
+            reports.append(report)
+        report["elapsed"] += inventory["elapsed"]
+        if inventory["error"] is not None:
+            report["error"] = "; ".join(error for error in (report["error"], inventory["error"]) if error is not None)
+        else:
+            count = sum(entity_type["count"] for entity_type in inventory["types"])
+            report["results"]["inventory"] = f"{len(inventory['types'])} types, {count} entities"
+
+def print_inventory(service, types, elapsed):
+    """
+    Prints the entity types of a service with their entity counts and attributes.
+    """
+    total = sum(entity_type["count"] for entity_type in types)
+    print(f"Service '{service}': {len(types)} types, {total} entities ({elapsed:.2f} s)")
+    for entity_type in types:
+        print(f"  {entity_type['type']}: {entity_type['count']} entities")
+        for name, attribute in sorted(entity_type["attrs"].items()):
+            print(f"    {name} ({', '.join(attribute['types'])})")
+
+def print_report(reports):
+    """
+    Prints the results of the operations of every service.
+    """
+    print('\n----------- Report -----------')
+    for report in reports:
+        results = ", ".join(f"{operation}: {result}" for operation, result in report["results"].items())
+        if report["error"] is not None:
+            results = f"{results}, " if results else ""
+            results += f"error: {report['error']}"
+        print(f"{report['service'] or '<default>'} ({report['elapsed']:.2f} s): {results or 'nothing to do'}")
+
+def run_service_operations(args, config, service, session=None):
+    """
+    Runs the operations given on the command line for one service.
+
+    Returns:
+        Dict with the service, the results of the operations, an error message (None if
+        all operations succeeded) and the elapsed time
+    """
+    start_time = time.time()
+    results = {}
+    error = None
+    client = create_client(config, service, session)
+    try:
+        if args.fetch:
+            # Fetch entities
+            print('Fetching all entities...')
+            type = get_type(args)
+            output = get_service_path(args.output, service)
+            if output and is_parquet(output):
+                count = fetch_entity_table(client, type, **get_filters(args)).to_parquet(output)
+                print(f"Wrote {count} entities to {output}")
+            elif output:
+                count = write_entities(output, client.iter_all_entities(type=type, **get_filters(args)))
+                print(f"Wrote {count} entities to {output}")
+            else:
+                result = client.get_all_entities(type=type, **get_filters(args))
+                print(result)
+                count = len(result)
+            results["fetch"] = f"{count} entities"
+        if args.delete:
+            # Delete entities
+            print('Deleting entities...')
+            type = get_type(args)
+            result = client.delete_all_entities(type=type, **get_filters(args))
+            print(result)
+            results["delete"] = [response.status_code for response in result] if isinstance(result, list) else result.status_code
+        if args.upload or args.replay:
+            # Upload data
+            data_path = args.upload or args.replay
+            dead_letter_path = get_service_path(args.dead_letter, service)
+            if args.upload:
+                data_json = iter_entities_from_file(data_path)
+            else:
+                data_json = iter_dead_letter_entities(data_path)
+            recover = args.recover or args.dead_letter is not None
+            if args.auto_batch:
+                stats = {}
+                client.batch_and_upload_entities(data_json, compact_geometries=args.compact_geometries,
+                                                 validate=args.validate, sanitize=args.sanitize,
+                                                 recover=args.recover, dead_letter_path=dead_letter_path,
+                                                 mode=args.mode, stats=stats)
+            else:
+                rejected = []
+                if args.validate or args.sanitize:
+                    data_json, rejected = client.validate_entities(data_json, sanitize=args.sanitize, mode=args.mode)
+                data_json = list(data_json)
+                stats = {"entities": len(data_json), "batches": 1, "failed_batches": 0,
+                         "rejected": len(rejected), "dead_letters": 0}
+                if recover:
+                    dead_letters = []
+                    client.upload_entities_with_recovery(data_json, dead_letters=dead_letters, mode=args.mode)
+                    print(f"{len(dead_letters)} entities rejected by the server")
+                    if dead_letter_path:
+                        client.write_dead_letters(dead_letter_path, dead_letters, rejected)
+                    stats["dead_letters"] = len(dead_letters)
+                else:
+                    result = client.upload_entities(data_json, mode=args.mode)
+                    print(result)
+                    # Sharded clients return one response per instance
+                    responses = result if isinstance(result, list) else [result]
+                    stats["failed_batches"] = int(any(response.status_code >= 400 for response in responses))
+            if recover:
+                upload_result = (f"{stats['entities'] - stats['dead_letters']} of {stats['entities'] + stats['rejected']} entities "
+                                 f"uploaded in {stats['batches']} batches, {stats['rejected'] + stats['dead_letters']} rejected")
+            else:
+                # Without recovery the server does not tell which entities of a failed batch were stored
+                upload_result = (f"{stats['entities']} entities sent in {stats['batches']} batches, "
+                                 f"{stats['failed_batches']} batches failed, {stats['rejected']} rejected")
+            print(f"Upload: {upload_result}")
+            results["upload"] = upload_result
+
+        if args.count:
+            # Count entities
+            result = client.count_entities(args.type, **get_filters(args))
+            print(f"Total entities in Orion: {result}")
+            results["count"] = result
+
+        if args.mirror:
+            # Refresh the local copy
+            mirror = refresh_mirror(client, get_service_path(args.mirror, service), type=get_type(args),
+                                    reconcile=True if args.reconcile else None)
+            results["mirror"] = f"{mirror['changed']} changed, {mirror['deleted']} deleted"
+
+        if args.subscribe:
+            # Receive changes until interrupted
+            types = args.type.split(',') if args.type else None
+            attrs = args.attrs.split(',') if args.attrs else None
+            received = run_change_feed(client, sink_path=args.subscribe, types=types, attrs=attrs, port=args.port,
+                                       notify_url=args.notify_url, duration=args.duration)
+            print(f"Received {received} entities in total")
+            results["subscribe"] = f"{received} entities"
+
+        if args.copy_to:
+            # Copy to another instance or service
+            with open(args.copy_to) as target_config_file:
+                target_config = json.load(target_config_file)["config"]
+            target_service = args.target_service if args.target_service is not None else service
+            target = create_client(target_config, target_service, session)
+            copied = copy_entities(client, target, type=get_type(args), mode=args.mode, fetch_workers=args.fetch_workers,
+                                   upload_workers=args.workers, recover=args.recover,
+                                   dead_letter_path=get_service_path(args.dead_letter, service), **get_filters(args))
+            results["copy"] = f"{copied['copied']} of {copied['fetched']} entities"
+
+        if args.aggregate or args.dashboard:
+            # Aggregations for dashboards
+            if args.dashboard:
+                panels = get_reduce_panels(parse_ssd(args.dashboard))
+            else:
+                if not args.traces:
+                    raise ValueError("--aggregate needs --traces")
+                panels = [{"name": args.aggregate, "type": get_type(args), "traces": args.traces.split(","),
+                           "reduce": args.aggregate}]
+            aggregates = aggregate_panels(client, panels, ttl=args.cache_ttl,
+                                          cache_path=get_service_path(args.aggregate_cache, service), **get_filters(args))
+            print(json.dumps(aggregates, indent=4, ensure_ascii=False))
+            results["aggregate"] = f"{len(aggregates)} panels"
+
+        if args.generate:
+            # Generate random data
+            type = get_type(args)
+            data = generate_simple_time_series(args.min, args.max, args.batch_size, type_name=type)
+            print('----------- Generated measurements -----------\n')
+            print(data)
+            data_json = time_series_to_json(data)
+            if args.metadata:
+                with open(args.metadata) as metadata_file:
+                    metadata_json = json.load(metadata_file)
+                    add_metadata(data_json, metadata_json)
+            result = client.upload_entities(data_json)
+            print(result)
+            results["generate"] = [response.status_code for response in result] if isinstance(result, list) else result.status_code
+    except Exception as e:
+        error = str(e)
+        print(f"Error in service '{service}': {error}")
+    return {"service": service, "results": results, "error": error, "elapsed": time.time() - start_time}
+
 def check_if_file_exists(path):
     """
     Checks if a given path exists
@@ -48,6 +313,31 @@ if __name__ == "__main__":
     parser.add_argument('-t', '--type',
                         help='Specifies the type of the entity to be fetched or modified.')
     
+    # Server-side filters (used with --fetch, --count and --delete)
+    parser.add_argument('-q', '--q', metavar='<query>',
+                        help='Attribute filter evaluated by Orion, e.g. "capacity>100;district==7"')
+
+    parser.add_argument('--mq', metavar='<query>',
+                        help='Metadata filter evaluated by Orion, e.g. "temperature.accuracy<0.5"')
+
+    parser.add_argument('--georel', metavar='<georel>',
+                        help='Geographical relationship, e.g. "near;maxDistance:1000" or "coveredBy" (use with --geometry and --coords)')
+
+    parser.add_argument('--geometry', choices=['point', 'line', 'polygon', 'box'],
+                        help='Reference geometry of a geographical query')
+
+    parser.add_argument('--coords', metavar='<coords>',
+                        help='Coordinates of the reference geometry as "lat,lon;lat,lon;...", e.g. "48.2,16.37"')
+
+    parser.add_argument('--id-pattern', metavar='<regex>',
+                        help='Regular expression the entity ids have to match')
+
+    parser.add_argument('--order-by', metavar='<attributes>',
+                        help='Comma separated attributes to sort the fetched entities by, prefix with ! for descending order')
+
+    parser.add_argument('-o', '--output', metavar='<output_file>',
+                        help='Write the fetched entities to a file (JSON, or NDJSON for .ndjson/.ndjson.gz) while they are fetched instead of printing them. For .parquet files the entities are collected in a compact columnar table and written as Parquet (requires pyarrow)')
+    
     # Delete all entities
     parser.add_argument('-d', '--delete',
                         action='store_true',
@@ -55,18 +345,98 @@ if __name__ == "__main__":
     
     # Upload data from JSON file
     parser.add_argument('-u', '--upload', metavar='<json_data_file>',
-                        help='Path to JSON file with data to upload. The data should be given as a JSON array of entities with IDs and attributes.')
+                        help='Path to JSON file with data to upload. The data should be given as a JSON array of entities with IDs and attributes, or as NDJSON with one entity per line (.ndjson, optionally compressed as .ndjson.gz or .ndjson.zst).')
+    
+    # How uploaded entities are written
+    parser.add_argument('--mode', choices=UPLOAD_MODES, default='append_strict',
+                        help='Upload mode (default append_strict): append_strict only creates new entities, append creates entities or overwrites the given attributes, update overwrites the given attributes of existing entities, replace replaces all attributes of existing entities. Use append to reload a dataset in place instead of --delete followed by --upload.')
+    
+    # Replay the entities of a dead-letter file
+    parser.add_argument('--replay', metavar='<dead_letter_file>',
+                        help='Path to a dead-letter file (see --dead-letter) whose entities are uploaded again')
     
     # Add auto-batching support
     parser.add_argument('--auto-batch', action='store_true',
                         help='Automatically batch large uploads to stay under 1MB')
     
+    parser.add_argument('--compact-geometries', action='store_true',
+                        help='Simplify or split geo:json attributes of entities that exceed the batch size, all other entities are uploaded unchanged (use with --auto-batch)')
+    
+    parser.add_argument('--validate', action='store_true',
+                        help='Check ids, names, forbidden characters, duplicate ids and sizes before uploading and skip invalid entities')
+
+    parser.add_argument('--sanitize', action='store_true',
+                        help='Like --validate, but fix invalid ids, names and values instead of skipping the entities')
+    
+    parser.add_argument('--recover', action='store_true',
+                        help='Split batches rejected as a whole to isolate the bad entities and upload all good ones; of partially applied batches only the entities listed in the error are rejected')
+
+    parser.add_argument('--dead-letter', metavar='<dead_letter_file>',
+                        help='Write the rejected entities with the server errors to this file for a later --replay (implies --recover)')
+    
     parser.add_argument('--count', action='store_true',
                         help='Count entities in Orion')
     
+    parser.add_argument('-i', '--inventory', metavar='<service>', nargs='*',
+                        help='List the entity types with their entity counts and attributes of the given services (queried concurrently) or of the --service')
+    
+    parser.add_argument('--mirror', metavar='<sqlite_file>',
+                        help='Create or incrementally refresh a local SQLite copy of the service (only entities of --type if given)')
+
+    parser.add_argument('--reconcile', action='store_true',
+                        help='Check for deleted entities while refreshing the --mirror (done once a day otherwise)')
+    
+    # Change feed
+    parser.add_argument('--subscribe', metavar='<ndjson_file>',
+                        help='Subscribe to changes of the entities of --type (comma separated types, all if not given) and append the notified entities to an NDJSON file until interrupted. The subscription is deleted on exit.')
+
+    parser.add_argument('--attrs', metavar='<attributes>',
+                        help='Comma separated attributes to watch with --subscribe (all if not given)')
+
+    parser.add_argument('--port', type=int, default=8668,
+                        help='Port of the local notification receiver (default 8668)')
+
+    parser.add_argument('--notify-url', metavar='<url>',
+                        help='URL under which Orion reaches the notification receiver (default http://<hostname>:<port>/notify)')
+
+    parser.add_argument('--duration', type=float,
+                        help='Stop the change feed after this many seconds')
+    
+    # Copy entities to another instance or service
+    parser.add_argument('--copy-to', metavar='<config_file>',
+                        help='Copy the entities of --service (only --type and matching the filters if given) to the Orion instance of this config file (use the same file as -c to copy between services)')
+
+    parser.add_argument('--target-service', metavar='<service_path>',
+                        help='Fiware-service to copy to with --copy-to (default: same as --service)')
+
+    parser.add_argument('-w', '--workers', type=int, default=4,
+                        help='Number of batches uploaded concurrently by --copy-to (default 4)')
+
+    parser.add_argument('--fetch-workers', type=int, default=1,
+                        help='Number of pages fetched concurrently by --copy-to (default 1)')
+    
+    # Aggregations for dashboards
+    parser.add_argument('--aggregate', choices=REDUCERS,
+                        help='Compute a reduction over the --traces of all entities of --type (matching the filters) in one streaming pass')
+
+    parser.add_argument('--traces', metavar='<attributes>',
+                        help='Comma separated attributes to aggregate with --aggregate')
+
+    parser.add_argument('--dashboard', metavar='<ssd_file>',
+                        help='Compute the reductions of all panels of a dashboard spec (e.g. examples/waste_collection_wien/example.ssd) which declare "reduce"')
+
+    parser.add_argument('--cache-ttl', type=float, default=CACHE_TTL_SECONDS,
+                        help=f'Number of seconds aggregation results are reused (default {CACHE_TTL_SECONDS})')
+
+    parser.add_argument('--aggregate-cache', metavar='<json_file>',
+                        help='File the aggregation results are cached in between runs (must contain {service} with several services)')
+    
     # Specify the Fiware-Service path
     parser.add_argument('-s', '--service', metavar='<service_path>',
-                        help='Name of the Fiware-service path.')
+                        help='Name of the Fiware-service path. Several services can be given as a comma separated list and as glob patterns (e.g. "wien-*") matched against the "services" list of the config file; the operations then run for all of them concurrently. File paths (--output, --mirror, --dead-letter, --aggregate-cache) must contain {service} in that case.')
+
+    parser.add_argument('--service-workers', type=int, default=8,
+                        help='Number of services processed concurrently (default 8)')
     
     # Generate random data
     parser.add_argument('-g', '--generate',
@@ -100,57 +470,45 @@ if __name__ == "__main__":
         with open(args.config[0]) as config_file:
             config_json = json.load(config_file)
             config = config_json["config"]
-            service = ""
-            if args.service:
-                service = args.service
-            client = FiwareClient(config["endpoint"], config["token"], service)
-
-            if args.fetch:
-                # Fetch entities
-                print('Fetching all entities...')
-                type = get_type(args)
-                result = client.get_all_entities(type=type)
-                print(result)
-            if args.delete:
-                # Delete entities
-                print('Deleting entities...')
-                type = get_type(args)
-                result = client.delete_all_entities(type=type)
-                print(result)
-            if args.upload:
-                # Upload data
-                if check_if_file_exists(args.upload) is False:
-                    print(f'Error: data file {args.upload} does not exist')
+
+        services = get_services(args.service, config)
+        if not services:
+            print('Error: no service selected')
+            exit(1)
+        data_path = args.upload or args.replay
+        if data_path and check_if_file_exists(data_path) is False:
+            print(f'Error: data file {data_path} does not exist')
+            exit(1)
+        if len(services) > 1:
+            if args.subscribe:
+                print('Error: --subscribe supports only one service')
+                exit(1)
+            for path in (args.output, args.mirror, args.dead_letter, args.aggregate_cache):
+                if path is not None and "{service}" not in path:
+                    print(f'Error: {path} must contain {{service}} to be used with several services')
                     exit(1)
-                with open(args.upload) as data_file:
-                    data_json = json.load(data_file)
-                    if args.auto_batch:
-                        results = client.batch_and_upload_entities(data_json)
-                        for i, result in enumerate(results):
-                            print(f"Batch {i+1} result: {result.status_code}")
-                    else:
-                        result = client.upload_entities(data_json)
-                        print(result)
-                        
-            if args.count:
-                # Count entities
-                result = client.get_all_entities(args.type)
-                print(f"Total entities in Orion: {len(result)}")
-                            
-            
-            if args.generate:
-                # Generate random data
-                type = get_type(args)
-                data = generate_simple_time_series(args.min, args.max, args.batch_size, type_name=type)
-                print('----------- Generated measurements -----------\n')
-                print(data)
-                data_json = time_series_to_json(data)
-                if args.metadata:
-                    with open(args.metadata) as metadata_file:
-                        metadata_json = json.load(metadata_file)
-                        add_metadata(data_json, metadata_json)
-                result = client.upload_entities(data_json)
-                print(result)
+
+        session = create_session(max(args.service_workers, args.workers, args.fetch_workers))
+        if len(services) == 1:
+            reports = [run_service_operations(args, config, services[0], session)]
+        else:
+            with ThreadPoolExecutor(max_workers=min(args.service_workers, len(services))) as executor:
+                reports = list(executor.map(lambda service: run_service_operations(args, config, service, session), services))
+
+        if args.inventory is not None:
+            # Inventory of one or more services
+            inventory_services = args.inventory or services
+            with ThreadPoolExecutor(max_workers=min(args.service_workers, len(inventory_services))) as executor:
+                inventories = list(executor.map(lambda name: get_inventory(config, name, session), inventory_services))
+            for inventory in inventories:
+                if inventory["error"] is None:
+                    print_inventory(inventory["service"], inventory["types"], inventory["elapsed"])
+            add_inventory_reports(reports, inventories)
+
+        if len(reports) > 1 and any(report["results"] or report["error"] is not None for report in reports):
+            print_report(reports)
+        if any(report["error"] is not None for report in reports):
+            exit(1)
 
     except FileNotFoundError:
         print('Error: Config file could not be loaded')
@@ -0,0 +1,176 @@
+import copy
+import json
+
+# Single-entity payloads are measured like a batch with one entity
+MAX_ENTITY_SIZE_BYTES = 1024 * 1024
+MAX_SIMPLIFY_STEPS = 32
+
+def get_entity_size_bytes(entity):
+    """
+    Returns the size in bytes of an update payload containing only the given entity.
+    """
+    payload = {
+        "actionType": "append_strict",
+        "entities": [entity]
+    }
+    return len(json.dumps(payload).encode("utf-8"))
+
+
+def get_geometry_attributes(entity):
+    """
+    Returns the names of the geo:json attributes of an entity.
+    """
+    return [name for name, attribute in entity.items()
+            if isinstance(attribute, dict) and attribute.get("type") == "geo:json"]
+
+
+def round_coordinates(coordinates, precision):
+    """
+    Rounds (nested) GeoJSON coordinate arrays to the given number of decimals.
+    """
+    if isinstance(coordinates, (list, tuple)):
+        if coordinates and not isinstance(coordinates[0], (list, tuple)):
+            return [round(value, precision) for value in coordinates]
+        return [round_coordinates(part, precision) for part in coordinates]
+    return coordinates
+
+
+def round_geometry(geometry, precision):
+    """
+    Returns a copy of a GeoJSON geometry with rounded coordinates.
+    """
+    geometry = dict(geometry)
+    if geometry.get("type") == "GeometryCollection":
+        geometry["geometries"] = [round_geometry(part, precision) for part in geometry["geometries"]]
+    else:
+        geometry["coordinates"] = round_coordinates(geometry["coordinates"], precision)
+    return geometry
+
+
+def simplify_geometry(geometry, tolerance, precision=None):
+    """
+    Simplifies a GeoJSON geometry with the topology-preserving Douglas-Peucker
+    algorithm of shapely. The tolerance is given in coordinate units (degrees for WGS84).
+    """
+    from shapely.geometry import shape, mapping
+
+    simplified = shape(geometry).simplify(tolerance, preserve_topology=True)
+    # mapping() returns tuples, convert back to plain JSON arrays
+    simplified = json.loads(json.dumps(mapping(simplified)))
+    if precision is not None:
+        simplified = round_geometry(simplified, precision)
+    return simplified
+
+
+def split_geometry_entity(entity, attribute_name):
+    """
+    Splits an entity whose geo:json attribute is a multi-part geometry into one entity
+    per part. The ids of the new entities are suffixed with the number of the part.
+    """
+    geometry = entity[attribute_name]["value"]
+    geometry_type = geometry.get("type", "")
+    if geometry_type == "GeometryCollection":
+        parts = geometry["geometries"]
+    elif geometry_type.startswith("Multi"):
+        part_type = geometry_type[len("Multi"):]
+        parts = [{"type": part_type, "coordinates": coordinates} for coordinates in geometry["coordinates"]]
+    else:
+        return [entity]
+
+    entities = []
+    for i, part in enumerate(parts):
+        part_entity = copy.deepcopy({key: value for key, value in entity.items() if key != attribute_name})
+        part_entity["id"] = f"{entity['id']}-part{i + 1}"
+        part_entity[attribute_name] = {**entity[attribute_name], "value": part}
+        entities.append(part_entity)
+    return entities
+
+
+def compact_entity(entity, max_size_bytes=MAX_ENTITY_SIZE_BYTES, tolerance=0, precision=6, split=False):
+    """
+    Compacts the geo:json attributes of an entity so that it fits into max_size_bytes.
+
+    Args:
+        entity: NGSI v2 entity
+        max_size_bytes: Size budget for a single-entity update payload
+        tolerance: Simplification tolerance which is always applied (0 to only simplify if needed)
+        precision: Number of decimals the coordinates are rounded to
+        split: Whether multi-part geometries which are too large are split into one entity per part
+
+    Returns:
+        List of entities which all fit into the size budget
+
+    Raises:
+        ValueError: if the entity cannot be made small enough
+    """
+    attribute_names = get_geometry_attributes(entity)
+    compacted = dict(entity)
+    for name in attribute_names:
+        compacted[name] = {**entity[name], "value": round_geometry(entity[name]["value"], precision)}
+        if tolerance > 0:
+            compacted[name]["value"] = simplify_geometry(compacted[name]["value"], tolerance, precision)
+
+    if get_entity_size_bytes(compacted) <= max_size_bytes:
+        return [compacted]
+
+    if not attribute_names:
+        raise ValueError(f"Entity {entity.get('id')} does not fit into {max_size_bytes/1024:.2f} KB and has no geometry to compact")
+
+    if split:
+        parts = split_geometry_entity(compacted, attribute_names[0])
+        if len(parts) > 1:
+            entities = []
+            for part in parts:
+                entities.extend(compact_entity(part, max_size_bytes, tolerance, precision, split=False))
+            return entities
+
+    # Increase the tolerance until the entity fits into the budget
+    step_tolerance = tolerance if tolerance > 0 else 10 ** -precision
+    for _ in range(MAX_SIMPLIFY_STEPS):
+        step_tolerance *= 2
+        for name in attribute_names:
+            compacted[name] = {**compacted[name], "value": simplify_geometry(compacted[name]["value"], step_tolerance, precision)}
+        if get_entity_size_bytes(compacted) <= max_size_bytes:
+            return [compacted]
+
+    raise ValueError(f"Entity {entity.get('id')} does not fit into {max_size_bytes/1024:.2f} KB")
+
+
+def compact_entities(entities, max_size_bytes=MAX_ENTITY_SIZE_BYTES, tolerance=0, precision=6, split=False, rejected=None):
+    """
+    Compacts the geo:json attributes of entities (see compact_entity) while they are
+    iterated and prints the achieved size reduction at the end. Without a tolerance only
+    the entities exceeding max_size_bytes are changed, all others are passed on as they are.
+
+    Args:
+        entities: Iterable of entities
+        rejected: List the entities that cannot be made small enough are appended to as
+                  (entity, problems) tuples (see validation_helper), raises ValueError if None
+        For the other arguments see compact_entity
+
+    Yields:
+        Entities which all fit into the size budget
+    """
+    size_before = 0
+    size_after = 0
+    count = 0
+    for entity in entities:
+        size = get_entity_size_bytes(entity)
+        if tolerance == 0 and size <= max_size_bytes:
+            yield entity
+            continue
+        try:
+            compacted = compact_entity(entity, max_size_bytes, tolerance, precision, split)
+        except ValueError as e:
+            if rejected is None:
+                raise
+            rejected.append((entity, [str(e)]))
+            continue
+        size_before += size
+        size_after += sum(get_entity_size_bytes(part) for part in compacted)
+        count += len(compacted)
+        yield from compacted
+
+    if size_before > 0:
+        print(f"Compacted geometries: {size_before/1024:.2f} KB -> {size_after/1024:.2f} KB "
+              f"({100 * (1 - size_after / size_before):.1f}% smaller), {count} compacted entities")
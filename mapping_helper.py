@@ -0,0 +1,151 @@
+import json
+import re
+import numpy as np
+import pandas as pd
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+# A mapping schema has the same shape as the attribute tables in
+# examples/agriculture_austria/types.py: it is keyed by the source property and every
+# entry gives the target attribute "name" and its NGSI "type". Optional keys:
+#   "source":    column (or list of columns) to read instead of the key of the entry
+#   "transform": function applied to the source column (a Series, or a DataFrame if
+#                "source" is a list) returning the attribute values for all rows at once
+#   "value":     constant value used for every entity
+
+
+def iter_features_from_file(path, chunk_size=READ_CHUNK_SIZE):
+    """
+    Incrementally parses the features array of a GeoJSON FeatureCollection file and yields
+    the features one at a time, without loading the whole document.
+    """
+    decoder = json.JSONDecoder()
+    features_start = re.compile(r'"features"\s*:\s*\[')
+    with open(path, "r", encoding="utf-8") as f:
+        buffer = ""
+        while True:
+            chunk = f.read(chunk_size)
+            buffer += chunk
+            match = features_start.search(buffer)
+            if match:
+                buffer = buffer[match.end():]
+                break
+            if not chunk:
+                return
+            # Keep the end of the buffer in case the key is split between two chunks
+            buffer = buffer[-32:]
+
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in " \t\r\n,":
+                position += 1
+            if position < len(buffer) and buffer[position] == "]":
+                return
+            try:
+                if position == len(buffer):
+                    raise json.JSONDecodeError("Buffer exhausted", buffer, position)
+                feature, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                # The next feature is not complete yet, read more data
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    raise
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield feature
+
+
+def read_feature_columns(path, properties, points=True, chunk_size=READ_CHUNK_SIZE):
+    """
+    Streams a GeoJSON FeatureCollection file into a DataFrame with the column 'id', one typed
+    column per selected property and the geometries: point coordinates go into the float
+    columns 'x' and 'y' (points=True), other geometries into the column 'geometry'.
+
+    Args:
+        path: Path of the GeoJSON file
+        properties: Names of the properties to extract
+        points: Whether all geometries are points
+        chunk_size: Number of characters read at once
+    """
+    ids = []
+    values = {name: [] for name in properties}
+    x = []
+    y = []
+    geometries = []
+    for feature in iter_features_from_file(path, chunk_size):
+        ids.append(feature.get("id"))
+        feature_properties = feature.get("properties") or {}
+        for name in properties:
+            values[name].append(feature_properties.get(name))
+        geometry = feature.get("geometry")
+        if points:
+            coordinates = geometry["coordinates"] if geometry else (np.nan, np.nan)
+            x.append(coordinates[0])
+            y.append(coordinates[1])
+        else:
+            geometries.append(geometry)
+
+    columns = {"id": pd.Series(ids, dtype=object)}
+    for name in properties:
+        columns[name] = pd.Series(values[name])
+    if points:
+        columns["x"] = np.array(x, dtype=float)
+        columns["y"] = np.array(y, dtype=float)
+    else:
+        columns["geometry"] = pd.Series(geometries, dtype=object)
+    return pd.DataFrame(columns)
+
+
+def xy_point_locations(xy):
+    """
+    Transform that builds point location values from the columns 'x' and 'y'.
+    """
+    return [{"type": "Point", "coordinates": [x, y]} for x, y in zip(xy["x"].tolist(), xy["y"].tolist())]
+
+
+def evaluate_schema(df, schema):
+    """
+    Computes the values of all attributes of a schema column-wise.
+
+    Returns:
+        List of (attribute name, NGSI type, list of values) tuples
+    """
+    columns = []
+    for key, spec in schema.items():
+        if "value" in spec:
+            values = [spec["value"]] * len(df)
+        else:
+            data = df[spec.get("source", key)]
+            if "transform" in spec:
+                data = spec["transform"](data)
+            if isinstance(data, pd.Series) and data.hasnans:
+                # Missing values are written as null instead of NaN
+                data = data.astype(object).where(data.notna(), None)
+            values = data.tolist() if hasattr(data, "tolist") else list(data)
+        columns.append((spec["name"], spec["type"], values))
+    return columns
+
+
+def iter_entities(df, entity_type, schema, id_column="id", metadata=False):
+    """
+    Converts a DataFrame into NGSI v2 entities according to a mapping schema and yields
+    them one at a time.
+
+    Args:
+        df: DataFrame with one row per entity
+        entity_type: NGSI entity type
+        schema: Mapping schema (see top of this module)
+        id_column: Column with the entity ids
+        metadata: Whether to add an empty metadata object to every attribute
+    """
+    columns = evaluate_schema(df, schema)
+    names = [(name, type) for name, type, _ in columns]
+    for entity_id, values in zip(df[id_column].tolist(), zip(*(values for _, _, values in columns))):
+        entity = {"id": entity_id, "type": entity_type}
+        for (name, type), value in zip(names, values):
+            if metadata:
+                entity[name] = {"type": type, "value": value, "metadata": {}}
+            else:
+                entity[name] = {"type": type, "value": value}
+        yield entity
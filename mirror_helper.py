@@ -0,0 +1,189 @@
+import json
+import sqlite3
+import time
+from datetime import datetime, timezone
+
+# Deleted entities are only noticed when the ids are reconciled, which needs one query over
+# all entities (ids and dateModified only) and is therefore done at most once per interval
+RECONCILE_INTERVAL_SECONDS = 24 * 60 * 60
+WRITE_BATCH_SIZE = 1000
+
+# The entities are stored as JSON in the column data and can be queried with the SQLite JSON
+# functions, e.g. SELECT id FROM entities WHERE json_extract(data, '$.capacity.value') > 100
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entities (
+    id TEXT NOT NULL,
+    type TEXT NOT NULL,
+    date_modified TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (id, type)
+);
+CREATE INDEX IF NOT EXISTS entities_type ON entities (type);
+CREATE INDEX IF NOT EXISTS entities_date_modified ON entities (date_modified);
+CREATE TABLE IF NOT EXISTS sync_state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def open_mirror(path):
+    """
+    Opens (and creates if necessary) the SQLite mirror database at path.
+    """
+    connection = sqlite3.connect(path)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def get_state(connection, key, default=None):
+    """
+    Returns a value of the sync state (e.g. the time of the last sync).
+    """
+    row = connection.execute("SELECT value FROM sync_state WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_state(connection, key, value):
+    """
+    Stores a value of the sync state.
+    """
+    connection.execute("INSERT OR REPLACE INTO sync_state (key, value) VALUES (?, ?)", (key, value))
+
+
+def get_date_modified(entity):
+    """
+    Removes the dateModified attribute (added by options=dateModified) from an entity and returns its value.
+    """
+    attribute = entity.pop("dateModified", None)
+    if isinstance(attribute, dict):
+        return attribute.get("value")
+    return attribute
+
+
+def store_entities(connection, entities):
+    """
+    Inserts or replaces entities in the mirror in batches.
+
+    Returns:
+        Tuple of the number of stored entities and the latest dateModified among them
+    """
+    count = 0
+    latest = None
+    rows = []
+    for entity in entities:
+        date_modified = get_date_modified(entity)
+        if date_modified is not None and (latest is None or date_modified > latest):
+            latest = date_modified
+        rows.append((entity["id"], entity["type"], date_modified, json.dumps(entity, ensure_ascii=False)))
+        if len(rows) >= WRITE_BATCH_SIZE:
+            connection.executemany("INSERT OR REPLACE INTO entities (id, type, date_modified, data) VALUES (?, ?, ?, ?)", rows)
+            count += len(rows)
+            rows = []
+    if rows:
+        connection.executemany("INSERT OR REPLACE INTO entities (id, type, date_modified, data) VALUES (?, ?, ?, ?)", rows)
+        count += len(rows)
+    return count, latest
+
+
+def reconcile_ids(connection, client, type=None):
+    """
+    Deletes the mirrored entities which no longer exist in Orion. Only ids, types and
+    dateModified are fetched. Entities whose dateModified differs from the mirrored one
+    (e.g. changes missed because of clock skew) are fetched again.
+
+    Returns:
+        Tuple of the number of deleted and the number of refetched entities
+    """
+    connection.execute("CREATE TEMP TABLE IF NOT EXISTS remote_ids (id TEXT, type TEXT, date_modified TEXT, PRIMARY KEY (id, type))")
+    connection.execute("DELETE FROM remote_ids")
+    remote = client.iter_all_entities(type, attrs="dateModified", options="keyValues")
+    rows = []
+    for entity in remote:
+        rows.append((entity["id"], entity["type"], entity.get("dateModified")))
+        if len(rows) >= WRITE_BATCH_SIZE:
+            connection.executemany("INSERT OR REPLACE INTO remote_ids VALUES (?, ?, ?)", rows)
+            rows = []
+    connection.executemany("INSERT OR REPLACE INTO remote_ids VALUES (?, ?, ?)", rows)
+
+    type_condition = "AND entities.type = ?" if type is not None else ""
+    type_params = (type,) if type is not None else ()
+    deleted = connection.execute(f"""
+        DELETE FROM entities
+        WHERE NOT EXISTS (SELECT 1 FROM remote_ids WHERE remote_ids.id = entities.id AND remote_ids.type = entities.type)
+        {type_condition}""", type_params).rowcount
+
+    stale = connection.execute("""
+        SELECT remote_ids.id, remote_ids.type FROM remote_ids
+        LEFT JOIN entities ON entities.id = remote_ids.id AND entities.type = remote_ids.type
+        WHERE entities.date_modified IS NULL OR entities.date_modified != remote_ids.date_modified""").fetchall()
+    refetched = 0
+    for id, entity_type in stale:
+        entity = client.get_entity(id, entity_type, options="dateModified")
+        if entity is not None:
+            refetched += store_entities(connection, [entity])[0]
+    return deleted, refetched
+
+
+def refresh_mirror(client, path, type=None, reconcile=None):
+    """
+    Brings the SQLite mirror of a service up to date. The first call copies all entities,
+    later calls only fetch the entities modified since the last sync
+    (q=dateModified>=<last sync>). Deletions are detected by reconciling the ids, which
+    happens once per RECONCILE_INTERVAL_SECONDS unless reconcile is True or False.
+
+    Args:
+        client: FiwareClient of the service to mirror
+        path: Path of the SQLite database
+        type: Only mirror entities of this type
+        reconcile: Whether to reconcile the ids (None: if the interval has passed)
+
+    Returns:
+        Dict with the number of changed, deleted and refetched entities
+    """
+    start_time = time.time()
+    scope = type or "*"
+    connection = open_mirror(path)
+    try:
+        with connection:
+            last_sync = get_state(connection, f"last_sync:{scope}")
+            filters = {"q": f"dateModified>={last_sync}"} if last_sync else {}
+            # Sorting by dateModified keeps the offset paging stable while entities change
+            changed = client.iter_all_entities(type, options="dateModified", order_by="dateModified", **filters)
+            changed_count, latest = store_entities(connection, changed)
+            if latest is not None:
+                set_state(connection, f"last_sync:{scope}", latest)
+
+            last_reconcile = float(get_state(connection, f"last_reconcile:{scope}", 0))
+            if reconcile is None:
+                # A full copy needs no reconciliation
+                reconcile = last_sync is not None and time.time() - last_reconcile > RECONCILE_INTERVAL_SECONDS
+            deleted, refetched = 0, 0
+            if reconcile or last_sync is None:
+                if reconcile:
+                    deleted, refetched = reconcile_ids(connection, client, type)
+                set_state(connection, f"last_reconcile:{scope}", str(time.time()))
+            set_state(connection, f"refreshed_at:{scope}", datetime.now(timezone.utc).isoformat())
+        total = connection.execute("SELECT COUNT(*) FROM entities").fetchone()[0]
+    finally:
+        connection.close()
+
+    print(f"Mirror {path}: {changed_count} changed, {deleted} deleted, {refetched} refetched, "
+          f"{total} entities ({time.time() - start_time:.2f} s)")
+    return {"changed": changed_count, "deleted": deleted, "refetched": refetched}
+
+
+def iter_mirrored_entities(path, type=None):
+    """
+    Yields the entities stored in a SQLite mirror.
+    """
+    connection = open_mirror(path)
+    try:
+        if type is None:
+            rows = connection.execute("SELECT data FROM entities ORDER BY id")
+        else:
+            rows = connection.execute("SELECT data FROM entities WHERE type = ? ORDER BY id", (type,))
+        for (data,) in rows:
+            yield json.loads(data)
+    finally:
+        connection.close()
@@ -0,0 +1,156 @@
+import json
+import queue
+import signal
+import socket
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from entity_file_helper import NDJSON_EXTENSIONS, append_entities, is_ndjson
+
+NOTIFICATION_PATH = "/notify"
+FLUSH_BATCH_SIZE = 1000
+FLUSH_INTERVAL_SECONDS = 1.0
+# Orion removes the subscription by itself this long after a run with a fixed duration
+# should have ended, in case the cleanup on exit did not happen (e.g. the process was killed)
+EXPIRES_MARGIN_SECONDS = 60
+
+
+def make_notification_handler(notifications):
+    """
+    Returns a request handler class that puts the entities of every notification
+    POSTed by Orion into the notifications queue and answers immediately.
+    """
+    class NotificationHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            try:
+                notification = json.loads(body)
+            except json.JSONDecodeError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            notifications.put(notification.get("data", []))
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            # Do not print a line for every notification
+            pass
+
+    return NotificationHandler
+
+
+def start_receiver(notifications, host="0.0.0.0", port=8668):
+    """
+    Starts the notification receiver in a background thread.
+
+    Returns:
+        The running ThreadingHTTPServer (stop it with shutdown())
+    """
+    server = ThreadingHTTPServer((host, port), make_notification_handler(notifications))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def update_cache(cache, entities):
+    """
+    Merges notified entities into a cache holding the latest state of every entity.
+    """
+    for entity in entities:
+        cache.setdefault(entity["id"], {}).update(entity)
+
+
+def raise_keyboard_interrupt(signum, frame):
+    """
+    Signal handler that stops the change feed like Ctrl+C, so the subscription is deleted.
+    """
+    raise KeyboardInterrupt
+
+
+def run_change_feed(client, sink_path=None, cache=None, types=None, attrs=None, host="0.0.0.0", port=8668,
+                    notify_url=None, duration=None, batch_size=FLUSH_BATCH_SIZE, flush_interval=FLUSH_INTERVAL_SECONDS):
+    """
+    Subscribes to changes of entities and receives them until duration has passed or the
+    process is interrupted (Ctrl+C or SIGTERM). The notified entities are batched and
+    appended to an NDJSON sink and/or merged into a cache dict. The subscription is
+    deleted on exit.
+
+    Args:
+        client: FiwareClient of the service to watch
+        sink_path: NDJSON file the notified entities are appended to
+        cache: Dict the latest state of every notified entity is kept in (keyed by id)
+        types: Entity types to watch (all if None)
+        attrs: Attributes to watch (all if None)
+        host: Interface the receiver listens on
+        port: Port the receiver listens on
+        notify_url: URL under which Orion reaches the receiver (default http://<hostname>:<port>/notify)
+        duration: Number of seconds to run (until interrupted if None)
+        batch_size: Number of entities after which the sink is written
+        flush_interval: Number of seconds after which received entities are written at the latest
+
+    Returns:
+        Number of received entities
+    """
+    # Fail before subscribing, the sink is only written after the first notification
+    if sink_path is not None and not is_ndjson(sink_path):
+        raise ValueError(f"The change feed sink must be an NDJSON file ({', '.join(NDJSON_EXTENSIONS)}), not {sink_path}")
+    if notify_url is None:
+        notify_url = f"http://{socket.getfqdn()}:{port}{NOTIFICATION_PATH}"
+    expires = None
+    if duration is not None:
+        expires = datetime.now(timezone.utc) + timedelta(seconds=duration + EXPIRES_MARGIN_SECONDS)
+
+    notifications = queue.Queue()
+    server = start_receiver(notifications, host, port)
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, raise_keyboard_interrupt)
+
+    received = 0
+    batch = []
+    subscription_id = None
+    start_time = time.time()
+    last_flush = start_time
+
+    def flush():
+        nonlocal batch, last_flush
+        if batch:
+            if sink_path is not None:
+                append_entities(sink_path, batch)
+            if cache is not None:
+                update_cache(cache, batch)
+            print(f"Received {len(batch)} entities ({received} in total)")
+        batch = []
+        last_flush = time.time()
+
+    try:
+        subscription_id = client.create_subscription(notify_url, types, attrs, expires=expires)
+        print(f"Created subscription {subscription_id}, receiving notifications on {notify_url}")
+        while duration is None or time.time() - start_time < duration:
+            timeout = flush_interval - (time.time() - last_flush)
+            if duration is not None:
+                timeout = min(timeout, duration - (time.time() - start_time))
+            try:
+                entities = notifications.get(timeout=max(timeout, 0.01))
+                batch.extend(entities)
+                received += len(entities)
+            except queue.Empty:
+                pass
+            if len(batch) >= batch_size or time.time() - last_flush >= flush_interval:
+                flush()
+    except KeyboardInterrupt:
+        print("Stopping change feed...")
+    finally:
+        if subscription_id is not None:
+            client.delete_subscription(subscription_id)
+            print(f"Deleted subscription {subscription_id}")
+        server.shutdown()
+        server.server_close()
+        # Keep what arrived until the receiver stopped
+        while not notifications.empty():
+            entities = notifications.get()
+            batch.extend(entities)
+            received += len(entities)
+        flush()
+    return received
@@ -0,0 +1,309 @@
+# Client for several independent Orion instances which together hold one dataset. Every
+# entity lives on exactly one instance (shard), chosen by a consistent hash of its id.
+
+import bisect
+import functools
+import hashlib
+import heapq
+import os
+import queue
+from concurrent.futures import ThreadPoolExecutor
+
+from client import FiwareClient
+
+# Points per endpoint on the hash ring, more points spread the entities more evenly
+VIRTUAL_NODES = 100
+# Number of entities per shard that may wait for the shard's uploader
+SHARD_QUEUE_SIZE = 10000
+
+
+def hash_key(key):
+    """
+    Returns a 64 bit hash of a string which is stable across processes and machines.
+    """
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def get_shard_path(path, shard_index):
+    """
+    Returns the path of a per-shard file, e.g. rejects.ndjson -> rejects.shard1.ndjson.
+    """
+    directory, name = os.path.split(path)
+    stem, dot, extension = name.partition(".")
+    return os.path.join(directory, f"{stem}.shard{shard_index}{dot}{extension}")
+
+
+def compare_by_order(order_by):
+    """
+    Returns a comparison function which orders entities like the orderBy parameter of Orion
+    (comma separated attributes, ! for descending order), used to merge sorted shard results.
+    """
+    keys = [(key.lstrip("!"), key.startswith("!")) for key in order_by.split(",")]
+
+    def get_value(entity, key):
+        if key in ("id", "type"):
+            return entity.get(key)
+        attribute = entity.get(key)
+        return attribute.get("value") if isinstance(attribute, dict) else attribute
+
+    def compare(entity1, entity2):
+        for key, descending in keys:
+            value1, value2 = get_value(entity1, key), get_value(entity2, key)
+            if value1 == value2:
+                continue
+            # Missing values go last
+            if value1 is None or value2 is None:
+                return 1 if value1 is None else -1
+            result = -1 if value1 < value2 else 1
+            return -result if descending else result
+        return 0
+
+    return compare
+
+
+class ShardedFiwareClient():
+    """
+    Client for a dataset spread over several Orion instances. Entities are routed to the
+    instances by a consistent hash of their id, so adding an instance only moves about
+    1/n of the entities. Uploads are batched and sent per instance in parallel, queries
+    are sent to all instances and the results merged. The methods mirror FiwareClient.
+    """
+    def __init__(self, endpoints, token, service=None, session=None) -> None:
+        """
+        @param endpoints: URLs of the API endpoints of the instances.
+        @param token: access token.
+        @param service: service path.
+        @param session: requests session shared by the clients of all instances.
+        """
+        self.endpoints = list(endpoints)
+        self.service = service
+        self.shards = [FiwareClient(endpoint, token, service, session) for endpoint in self.endpoints]
+        ring = sorted((hash_key(f"{endpoint}#{node}"), index)
+                      for index, endpoint in enumerate(self.endpoints) for node in range(VIRTUAL_NODES))
+        self.ring_hashes = [point for point, _ in ring]
+        self.ring_shards = [index for _, index in ring]
+
+    def get_shard_index(self, entity_id):
+        """
+        Returns the index of the instance an entity id belongs to.
+        """
+        position = bisect.bisect(self.ring_hashes, hash_key(entity_id)) % len(self.ring_hashes)
+        return self.ring_shards[position]
+
+    def get_shard(self, entity_id):
+        """
+        Returns the client of the instance an entity id belongs to.
+        """
+        return self.shards[self.get_shard_index(entity_id)]
+
+    def split_by_shard(self, entities):
+        """
+        Splits a list of entities into one list per instance.
+        """
+        parts = [[] for _ in self.shards]
+        for entity in entities:
+            parts[self.get_shard_index(entity["id"])].append(entity)
+        return parts
+
+    def map_shards(self, function, *args):
+        """
+        Calls function(shard, *args) for every instance in parallel and returns the results in shard order.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            return list(executor.map(lambda shard: function(shard, *args), self.shards))
+
+    def map_parts(self, function, parts):
+        """
+        Calls function(shard, part) in parallel for every instance with a non-empty part.
+        """
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            futures = [executor.submit(function, shard, part) for shard, part in zip(self.shards, parts) if part]
+            return [future.result() for future in futures]
+
+    # Uploads
+
+    def upload_entities(self, entities, key_values=False, mode="append_strict"):
+        """
+        Uploads entities, one request per instance in parallel.
+
+        Returns:
+            List of responses
+        """
+        return self.map_parts(lambda shard, part: shard.upload_entities(part, key_values, mode),
+                              self.split_by_shard(entities))
+
+    def upload_entities_with_recovery(self, entities, key_values=False, dead_letters=None, mode="append_strict"):
+        """
+        Uploads entities per instance in parallel with bisecting recovery (see FiwareClient.upload_entities_with_recovery).
+        """
+        if dead_letters is None:
+            dead_letters = []
+        results = self.map_parts(lambda shard, part: shard.upload_entities_with_recovery(part, key_values, dead_letters, mode),
+                                 self.split_by_shard(entities))
+        return [response for responses in results for response in responses]
+
+    def upload_batch(self, batch, key_values=False, mode="append_strict", recover=False, dead_letters=None):
+        """
+        Uploads one batch, split per instance in parallel (see FiwareClient.upload_batch).
+        """
+        results = self.map_parts(lambda shard, part: shard.upload_batch(part, key_values, mode, recover, dead_letters),
+                                 self.split_by_shard(batch))
+        return [response for responses in results for response in responses]
+
+    def iter_entity_batches(self, entities, max_batch_size_bytes=1024*1024):
+        """
+        Groups entities into size-limited batches (see FiwareClient.iter_entity_batches).
+        """
+        return self.shards[0].iter_entity_batches(entities, max_batch_size_bytes)
+
+    def validate_entities(self, *args, **kwargs):
+        """
+        Checks entities before uploading them (see FiwareClient.validate_entities).
+        """
+        return self.shards[0].validate_entities(*args, **kwargs)
+
+    def write_dead_letters(self, *args, **kwargs):
+        """
+        Writes rejected entities to a dead-letter file (see FiwareClient.write_dead_letters).
+        """
+        return self.shards[0].write_dead_letters(*args, **kwargs)
+
+    def batch_and_upload_entities(self, entities, dead_letter_path=None, stats=None, **kwargs):
+        """
+        Routes entities to their instances and batches and uploads them per instance in
+        parallel (see FiwareClient.batch_and_upload_entities for the arguments). Every
+        instance has a bounded queue, so entities are streamed and not collected first.
+        Dead letters are written to one file per instance (see get_shard_path), stats
+        receives the sums of the statistics of the instances.
+
+        Returns:
+            List of responses of all instances
+        """
+        queues = [queue.Queue(maxsize=SHARD_QUEUE_SIZE) for _ in self.shards]
+        shard_stats = [{} for _ in self.shards]
+        done = object()
+
+        def iter_queue(shard_queue):
+            while True:
+                entity = shard_queue.get()
+                if entity is done:
+                    return
+                yield entity
+
+        def upload(index):
+            shard_dead_letter_path = get_shard_path(dead_letter_path, index) if dead_letter_path else None
+            entities = iter_queue(queues[index])
+            try:
+                return self.shards[index].batch_and_upload_entities(entities, dead_letter_path=shard_dead_letter_path,
+                                                                    stats=shard_stats[index], **kwargs)
+            except Exception:
+                # Do not block the router if this uploader failed
+                for _ in entities:
+                    pass
+                raise
+
+        with ThreadPoolExecutor(max_workers=len(self.shards)) as executor:
+            futures = [executor.submit(upload, index) for index in range(len(self.shards))]
+            try:
+                for entity in entities:
+                    queues[self.get_shard_index(entity["id"])].put(entity)
+            finally:
+                for shard_queue in queues:
+                    shard_queue.put(done)
+            results = [future.result() for future in futures]
+        if stats is not None:
+            stats.clear()
+            for statistics in shard_stats:
+                for key, value in statistics.items():
+                    stats[key] = stats.get(key, 0) + value
+        return [response for responses in results for response in responses]
+
+    # Queries
+
+    def iter_entity_pages(self, type=None, page_size=1000, **query):
+        """
+        Yields the pages of all instances one instance after another (see FiwareClient.iter_entity_pages).
+        """
+        for shard in self.shards:
+            yield from shard.iter_entity_pages(type, page_size, **query)
+
+    def iter_all_entities(self, type=None, page_size=1000, **query):
+        """
+        Yields the entities of all instances. With order_by the sorted results of the
+        instances are merged, so the order is the same as with a single instance.
+        """
+        if query.get("order_by"):
+            iterators = [shard.iter_all_entities(type, page_size, **query) for shard in self.shards]
+            key = functools.cmp_to_key(compare_by_order(query["order_by"]))
+            yield from heapq.merge(*iterators, key=key)
+        else:
+            for page in self.iter_entity_pages(type, page_size, **query):
+                yield from page
+
+    def get_all_entities(self, type=None, **filters):
+        """
+        Gets the entities of all instances in parallel and merges them.
+        """
+        results = self.map_shards(lambda shard: shard.get_all_entities(type, **filters))
+        if filters.get("order_by"):
+            key = functools.cmp_to_key(compare_by_order(filters["order_by"]))
+            return list(heapq.merge(*results, key=key))
+        return [entity for result in results for entity in result]
+
+    def count_entities(self, type=None, **filters):
+        """
+        Counts the entities of all instances in parallel.
+        """
+        return sum(self.map_shards(lambda shard: shard.count_entities(type, **filters)))
+
+    def get_entity(self, entity_id, type=None, options=None):
+        """
+        Gets a single entity from its instance (None if it does not exist).
+        """
+        return self.get_shard(entity_id).get_entity(entity_id, type, options)
+
+    def query_entity(self, measurement_request):
+        """
+        Queries latest data for an entity on its instance (see FiwareClient.query_entity).
+        """
+        return self.get_shard(measurement_request.urn).query_entity(measurement_request)
+
+    def get_entity_types(self, page_size=1000):
+        """
+        Gets the entity types of all instances and merges their counts and attributes.
+        """
+        types = {}
+        for shard_types in self.map_shards(lambda shard: shard.get_entity_types(page_size)):
+            for entity_type in shard_types:
+                merged = types.setdefault(entity_type["type"], {"type": entity_type["type"], "count": 0, "attrs": {}})
+                merged["count"] += entity_type.get("count", 0)
+                for name, attribute in entity_type.get("attrs", {}).items():
+                    attribute_types = merged["attrs"].setdefault(name, {"types": []})["types"]
+                    attribute_types.extend(t for t in attribute["types"] if t not in attribute_types)
+        return [types[name] for name in sorted(types)]
+
+    def delete_all_entities(self, type=None, **filters):
+        """
+        Deletes the matching entities on all instances in parallel.
+
+        Returns:
+            List of responses
+        """
+        return self.map_shards(lambda shard: shard.delete_all_entities(type, **filters))
+
+    # Subscriptions
+
+    def create_subscription(self, *args, **kwargs):
+        """
+        Creates the same subscription on all instances (see FiwareClient.create_subscription).
+
+        Returns:
+            List of the subscription ids of the instances
+        """
+        return self.map_shards(lambda shard: shard.create_subscription(*args, **kwargs))
+
+    def delete_subscription(self, subscription_ids):
+        """
+        Deletes the subscriptions created by create_subscription.
+        """
+        return [shard.delete_subscription(subscription_id) for shard, subscription_id in zip(self.shards, subscription_ids)]
@@ -0,0 +1,20 @@
+import os
+import sys
+
+import pytest
+
+# The modules of the tool live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from orion_stub import OrionStub  # noqa: E402
+
+
+@pytest.fixture
+def orion():
+    """
+    Runs a local Orion stand-in for one test.
+    """
+    stub = OrionStub()
+    stub.endpoint = stub.start()
+    yield stub
+    stub.stop()
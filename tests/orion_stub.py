@@ -0,0 +1,207 @@
+# Local stand-in for the parts of the Orion NGSI v2 API used by the client: batch updates
+# (non-atomic like Orion, see op_update), paged and ordered entity queries, types and
+# subscriptions with HTTP notifications. Entities are kept in memory per Fiware-service.
+
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+# Characters Orion rejects in ids and attribute values
+FORBIDDEN_CHARS = set("<>\"'=;()")
+
+
+def has_forbidden_chars(entity):
+    """
+    Returns whether Orion would reject an entity because of forbidden characters.
+    """
+    values = [entity["id"]] + [attribute.get("value") for name, attribute in entity.items()
+                               if name not in ("id", "type") and isinstance(attribute, dict)]
+    return any(isinstance(value, str) and FORBIDDEN_CHARS & set(value) for value in values)
+
+
+class OrionStub():
+    """
+    In-memory Orion for tests. start() returns the API endpoint (http://localhost:<port>/v2).
+    """
+    def __init__(self) -> None:
+        self.entities = {}
+        self.subscriptions = {}
+        # (method, path, actionType or query) of every request
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer(("localhost", 0), make_handler(self))
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://localhost:{self.server.server_address[1]}/v2"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_entities(self, service):
+        return self.entities.setdefault(service or "", {})
+
+    def op_update(self, service, action_type, entities):
+        """
+        Applies a batch update like Orion: a malformed request is rejected as a whole (400),
+        otherwise every entity is processed on its own and the ids of the failed ones are
+        listed in a 422 response, while the other entities are stored.
+        """
+        stored = self.get_entities(service)
+        if any(has_forbidden_chars(entity) for entity in entities):
+            return 400, {"error": "BadRequest", "description": "Invalid characters in attribute value"}
+        failed = []
+        changed = []
+        with self.lock:
+            for entity in entities:
+                exists = entity["id"] in stored
+                if action_type == "delete":
+                    stored.pop(entity["id"], None)
+                elif action_type == "append_strict" and exists:
+                    failed.append(entity["id"])
+                elif action_type in ("update", "replace") and not exists:
+                    failed.append(entity["id"])
+                else:
+                    if action_type in ("append", "update") and exists:
+                        stored[entity["id"]].update(entity)
+                    else:
+                        stored[entity["id"]] = dict(entity)
+                    changed.append(stored[entity["id"]])
+        self.notify(changed)
+        if failed:
+            reason = "Already Exists" if action_type == "append_strict" else "The requested entity has not been found"
+            return 422, {"error": "Unprocessable", "description": f"{reason}: [ {', '.join(failed)} ]"}
+        return 204, None
+
+    def notify(self, entities):
+        """
+        POSTs the changed entities to the receivers of the matching subscriptions.
+        """
+        for subscription_id, subscription in list(self.subscriptions.items()):
+            types = [subject.get("type") for subject in subscription["subject"]["entities"]]
+            attrs = subscription["notification"].get("attrs")
+            data = [{name: value for name, value in entity.items() if name in ("id", "type") or not attrs or name in attrs}
+                    for entity in entities if None in types or entity["type"] in types]
+            if data:
+                requests.post(subscription["notification"]["http"]["url"],
+                              json={"subscriptionId": subscription_id, "data": data}, timeout=5)
+
+    def query_entities(self, service, query):
+        """
+        Returns the entities of a service matching the type and idPattern of a query, sorted
+        by id or by orderBy.
+        """
+        entities = sorted(self.get_entities(service).values(), key=lambda entity: entity["id"])
+        if "type" in query:
+            entities = [entity for entity in entities if entity["type"] in query["type"].split(",")]
+        if "idPattern" in query:
+            entities = [entity for entity in entities if re.match(query["idPattern"], entity["id"])]
+        if "orderBy" in query:
+            # Sort by the keys in reverse order, the stable sort keeps the order of the earlier keys
+            for key in reversed(query["orderBy"].split(",")):
+                name = key.lstrip("!")
+                entities = sorted(entities, key=lambda entity: get_sort_value(entity, name), reverse=key.startswith("!"))
+        if "attrs" in query:
+            keep = set(query["attrs"].split(","))
+            entities = [{name: value for name, value in entity.items() if name in ("id", "type") or name in keep}
+                        for entity in entities]
+        if "keyValues" in query.get("options", ""):
+            entities = [{name: value["value"] if isinstance(value, dict) else value for name, value in entity.items()}
+                        for entity in entities]
+        return entities
+
+    def get_types(self, service):
+        """
+        Returns the entity types of a service with their counts and attribute types like /v2/types.
+        """
+        types = {}
+        for entity in self.get_entities(service).values():
+            entity_type = types.setdefault(entity["type"], {"type": entity["type"], "count": 0, "attrs": {}})
+            entity_type["count"] += 1
+            for name, attribute in entity.items():
+                if name not in ("id", "type"):
+                    attribute_types = entity_type["attrs"].setdefault(name, {"types": []})["types"]
+                    if attribute["type"] not in attribute_types:
+                        attribute_types.append(attribute["type"])
+        return [types[name] for name in sorted(types)]
+
+
+def get_sort_value(entity, name):
+    """
+    Returns the value an entity is sorted by for orderBy (entities without it go last).
+    """
+    value = entity.get(name)
+    if isinstance(value, dict):
+        value = value.get("value")
+    return (value is None, value if value is not None else 0)
+
+
+def make_handler(stub):
+    """
+    Returns the request handler class of a stub.
+    """
+    class OrionHandler(BaseHTTPRequestHandler):
+        def send(self, status, body=None, headers=None):
+            data = json.dumps(body).encode("utf-8") if body is not None else b""
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(data)))
+            if body is not None:
+                self.send_header("Content-Type", "application/json")
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            path = urlparse(self.path).path
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            service = self.headers.get("fiware-service")
+            if path == "/v2/op/update":
+                stub.requests.append(("POST", path, body["actionType"]))
+                status, response = stub.op_update(service, body["actionType"], body["entities"])
+                return self.send(status, response)
+            if path == "/v2/subscriptions":
+                stub.requests.append(("POST", path, None))
+                subscription_id = str(len(stub.subscriptions) + 1)
+                stub.subscriptions[subscription_id] = body
+                return self.send(201, headers={"Location": f"/v2/subscriptions/{subscription_id}"})
+            self.send(404, {"error": "NotFound"})
+
+        def do_DELETE(self):
+            path = urlparse(self.path).path
+            stub.requests.append(("DELETE", path, None))
+            match = re.fullmatch(r"/v2/subscriptions/(\w+)", path)
+            if match and stub.subscriptions.pop(match.group(1), None) is not None:
+                return self.send(204)
+            self.send(404, {"error": "NotFound"})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = {name: values[0] for name, values in parse_qs(url.query).items()}
+            stub.requests.append(("GET", url.path, query))
+            service = self.headers.get("fiware-service")
+            if url.path == "/v2/entities":
+                entities = stub.query_entities(service, query)
+                offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+                headers = {"Fiware-Total-Count": str(len(entities))} if "count" in query.get("options", "") else None
+                return self.send(200, entities[offset:offset + limit], headers)
+            if url.path == "/v2/types":
+                types = stub.get_types(service)
+                offset, limit = int(query.get("offset", 0)), int(query.get("limit", 20))
+                headers = {"Fiware-Total-Count": str(len(types))} if "count" in query.get("options", "") else None
+                return self.send(200, types[offset:offset + limit], headers)
+            match = re.fullmatch(r"/v2/entities/([^/]+)", url.path)
+            if match and match.group(1) in stub.get_entities(service):
+                return self.send(200, stub.get_entities(service)[match.group(1)])
+            self.send(404, {"error": "NotFound"})
+
+        def log_message(self, format, *args):
+            pass
+
+    return OrionHandler
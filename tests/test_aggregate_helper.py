@@ -0,0 +1,43 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from aggregate_helper import aggregate
+from client import FiwareClient
+
+
+def make_entity(index, kind):
+    return {"id": f"urn:ngsi-ld:Bin:{index}", "type": "Bin",
+            "capacity": {"type": "Number", "value": index}, "kind": {"type": "Text", "value": kind}}
+
+
+def test_concurrent_services_keep_their_own_cache_files(orion, tmp_path):
+    services = ["a", "b", "c", "d"]
+    for number, service in enumerate(services, 1):
+        FiwareClient(orion.endpoint, "token", service).upload_entities(
+            [make_entity(i, "glass" if i % 2 else "paper") for i in range(10 * number)])
+
+    def run(service):
+        client = FiwareClient(orion.endpoint, "token", service)
+        cache_path = str(tmp_path / f"cache_{service}.json")
+        return [aggregate(client, "Bin", ["capacity"], "sum", cache_path=cache_path),
+                aggregate(client, "Bin", ["kind"], "unique_trace_counts", cache_path=cache_path)]
+
+    with ThreadPoolExecutor(max_workers=len(services)) as executor:
+        results = list(executor.map(run, services))
+
+    for number, (service, (sums, counts)) in enumerate(zip(services, results), 1):
+        assert sums == {"capacity": sum(range(10 * number))}
+        assert counts == {"kind": {"glass": 5 * number, "paper": 5 * number}}
+        with open(tmp_path / f"cache_{service}.json", encoding="utf-8") as f:
+            keys = [json.loads(key) for key in json.load(f)]
+        assert len(keys) == 2
+        assert all(key[:2] == [orion.endpoint, service] for key in keys)
+
+
+def test_cached_result_needs_no_requests(orion):
+    client = FiwareClient(orion.endpoint, "token", "cached")
+    client.upload_entities([make_entity(i, "glass") for i in range(3)])
+    assert aggregate(client, "Bin", ["capacity"], "sum") == {"capacity": 3}
+    requests_before = len(orion.requests)
+    assert aggregate(client, "Bin", ["capacity"], "sum") == {"capacity": 3}
+    assert len(orion.requests) == requests_before
@@ -0,0 +1,49 @@
+from client import FiwareClient
+
+
+def make_entity(index, name="Sensor"):
+    return {"id": f"urn:ngsi-ld:{name}:{index}", "type": "Sensor",
+            "name": {"type": "Text", "value": name, "metadata": {}}}
+
+
+def count_updates(orion):
+    return sum(1 for _, path, _ in orion.requests if path == "/v2/op/update")
+
+
+def test_recovery_rejects_only_existing_entities_of_partial_failure(orion):
+    client = FiwareClient(orion.endpoint, "token", "test")
+    client.upload_entities([make_entity(5)])
+    dead_letters = []
+    client.upload_entities_with_recovery([make_entity(i) for i in range(16)], dead_letters=dead_letters)
+
+    assert count_updates(orion) == 2
+    assert len(orion.entities["test"]) == 16
+    assert [record["entity"]["id"] for record in dead_letters] == ["urn:ngsi-ld:Sensor:5"]
+    assert dead_letters[0]["status"] == 422
+
+
+def test_recovery_bisects_rejected_batch(orion):
+    client = FiwareClient(orion.endpoint, "token", "test")
+    entities = [make_entity(i) for i in range(16)]
+    entities[11] = make_entity(11, "Bad<name>")
+    dead_letters = []
+    responses = client.upload_entities_with_recovery(entities, dead_letters=dead_letters)
+
+    assert [record["entity"]["id"] for record in dead_letters] == [entities[11]["id"]]
+    assert sorted(orion.entities["test"]) == sorted(entity["id"] for i, entity in enumerate(entities) if i != 11)
+    # 1 + 2 requests per level of the 4 levels below the full batch
+    assert len(responses) == count_updates(orion) == 9
+
+
+def test_batch_upload_stats_count_entities_not_requests(orion):
+    client = FiwareClient(orion.endpoint, "token", "test")
+    entities = [make_entity(i) for i in range(50)]
+    entities[7] = make_entity(7, "Bad<name>")
+    stats = {}
+    client.batch_and_upload_entities(iter(entities), max_batch_size_bytes=2000, recover=True, stats=stats)
+
+    assert len(orion.entities["test"]) == 49
+    assert stats["entities"] == 50
+    assert stats["dead_letters"] == 1
+    assert stats["batches"] > 1
+    assert stats["failed_batches"] == 0
@@ -0,0 +1,20 @@
+import pandas as pd
+
+from entity_table import EntityTable
+
+
+def test_integers_survive_conversion_of_a_number_column_to_a_list(tmp_path):
+    table = EntityTable()
+    table.append_entities([
+        {"id": "a", "type": "Sensor", "reading": {"type": "Number", "value": 1}, "level": {"type": "Number", "value": 3}},
+        {"id": "b", "type": "Sensor", "reading": {"type": "Text", "value": "broken"}},
+        {"id": "c", "type": "Sensor", "reading": {"type": "Number", "value": 2.5}, "level": {"type": "Number", "value": 4}},
+    ])
+
+    assert table.columns["reading"] == [1, "broken", 2.5]
+    assert isinstance(table.columns["reading"][0], int)
+    assert table.to_dataframe()["level"].tolist() == [3, pd.NA, 4]
+
+    path = str(tmp_path / "sensors.parquet")
+    assert table.to_parquet(path) == 3
+    assert pd.read_parquet(path)["reading"].tolist() == ["1", "broken", "2.5"]
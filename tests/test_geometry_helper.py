@@ -0,0 +1,31 @@
+import pytest
+
+from geometry_helper import compact_entities, get_entity_size_bytes
+
+
+def make_entity(index, coordinates, text=""):
+    return {"id": f"urn:ngsi-ld:Area:{index}", "type": "Area",
+            "location": {"type": "geo:json", "value": {"type": "LineString", "coordinates": coordinates}},
+            "text": {"type": "Text", "value": text}}
+
+
+def test_compact_entities_only_changes_entities_over_the_budget():
+    line = [[16.123456789 + i * 1e-4, 48.123456789 + (i % 2) * 1e-9] for i in range(2000)]
+    small = make_entity(1, line[:2])
+    large = make_entity(2, line)
+    too_large = make_entity(3, line[:2], "x" * 20000)
+    max_size_bytes = get_entity_size_bytes(small) + 1000
+    rejected = []
+
+    compacted = compact_entities(iter([small, large, too_large]), max_size_bytes, rejected=rejected)
+    assert next(compacted) is small
+    result = list(compacted)
+
+    assert [entity["id"] for entity in result] == [large["id"]]
+    assert get_entity_size_bytes(result[0]) <= max_size_bytes
+    assert [entity["id"] for entity, _ in rejected] == [too_large["id"]]
+
+
+def test_compact_entities_raises_without_rejected_list():
+    with pytest.raises(ValueError):
+        list(compact_entities([make_entity(1, [[0, 0], [1, 1]], "x" * 2000)], 1000))
@@ -0,0 +1,59 @@
+import socket
+import threading
+import time
+
+import pytest
+
+from client import FiwareClient
+from entity_file_helper import iter_entities_from_file
+from notification_helper import run_change_feed
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError("Condition not met in time")
+        time.sleep(0.05)
+
+
+def make_entity(index):
+    return {"id": f"urn:ngsi-ld:Sensor:{index}", "type": "Sensor",
+            "temperature": {"type": "Number", "value": index, "metadata": {}}}
+
+
+def test_change_feed_writes_notified_entities_and_deletes_subscription(orion, tmp_path):
+    client = FiwareClient(orion.endpoint, "token", "test")
+    sink_path = str(tmp_path / "changes.ndjson")
+    port = get_free_port()
+    received = []
+    feed = threading.Thread(target=lambda: received.append(run_change_feed(
+        client, sink_path, types=["Sensor"], host="localhost", port=port,
+        notify_url=f"http://localhost:{port}/notify", duration=2, flush_interval=0.1)))
+    feed.start()
+    wait_for(lambda: orion.subscriptions)
+    subscription = next(iter(orion.subscriptions.values()))
+    assert subscription["subject"]["entities"] == [{"idPattern": ".*", "type": "Sensor"}]
+
+    client.upload_entities([make_entity(i) for i in range(3)])
+    client.upload_entities([make_entity(3)])
+    client.upload_entities([{"id": "urn:ngsi-ld:Other:1", "type": "Other"}])
+    feed.join(timeout=10)
+
+    assert received == [4]
+    assert sorted(entity["id"] for entity in iter_entities_from_file(sink_path)) == [make_entity(i)["id"] for i in range(4)]
+    assert orion.subscriptions == {}
+    assert ("DELETE", "/v2/subscriptions/1", None) in orion.requests
+
+
+def test_change_feed_rejects_non_ndjson_sink_before_subscribing(orion, tmp_path):
+    client = FiwareClient(orion.endpoint, "token", "test")
+    with pytest.raises(ValueError):
+        run_change_feed(client, str(tmp_path / "changes.json"), port=get_free_port(), duration=1)
+    assert not any(path == "/v2/subscriptions" for _, path, _ in orion.requests)
@@ -0,0 +1,84 @@
+import pytest
+
+from orion_stub import OrionStub
+from sharded_client import ShardedFiwareClient, get_shard_path
+
+
+@pytest.fixture
+def shards():
+    """
+    Runs two Orion stand-ins, one per shard.
+    """
+    stubs = [OrionStub(), OrionStub()]
+    for stub in stubs:
+        stub.endpoint = stub.start()
+    yield stubs
+    for stub in stubs:
+        stub.stop()
+
+
+def make_entity(index):
+    entity_type = "Sensor" if index % 3 else "Gauge"
+    return {"id": f"urn:ngsi-ld:{entity_type}:{index:04d}", "type": entity_type,
+            "level": {"type": "Number", "value": (index * 37) % 101, "metadata": {}}}
+
+
+def test_routing_is_stable_and_adding_a_shard_moves_few_ids():
+    ids = [f"urn:ngsi-ld:Sensor:{index}" for index in range(3000)]
+    endpoints = ["http://orion-a/v2", "http://orion-b/v2"]
+    client = ShardedFiwareClient(endpoints, "token")
+    routing = [client.get_shard_index(entity_id) for entity_id in ids]
+
+    assert routing == [ShardedFiwareClient(endpoints, "token").get_shard_index(entity_id) for entity_id in ids]
+    assert 0.4 < routing.count(0) / len(ids) < 0.6
+
+    grown = ShardedFiwareClient(endpoints + ["http://orion-c/v2"], "token")
+    moved = [(old, grown.get_shard_index(entity_id)) for entity_id, old in zip(ids, routing)
+             if grown.get_shard_index(entity_id) != old]
+    # Only the ids taken over by the new shard move, about a third of them
+    assert all(new == 2 for _, new in moved)
+    assert 0.2 < len(moved) / len(ids) < 0.45
+
+
+def test_get_shard_path():
+    assert get_shard_path("out/rejects.ndjson.gz", 1) == "out/rejects.shard1.ndjson.gz"
+
+
+def test_upload_fetch_and_count_round_trip(shards):
+    client = ShardedFiwareClient([stub.endpoint for stub in shards], "token", "test")
+    entities = [make_entity(index) for index in range(300)]
+    stats = {}
+    client.batch_and_upload_entities(iter(entities), max_batch_size_bytes=4000, stats=stats)
+
+    assert stats["entities"] == 300 and stats["failed_batches"] == 0
+    for index, stub in enumerate(shards):
+        stored = set(stub.entities["test"])
+        assert stored == {entity["id"] for entity in entities if client.get_shard_index(entity["id"]) == index}
+        assert 0 < len(stored) < 300
+
+    assert client.count_entities() == 300
+    assert client.count_entities("Gauge") == 100
+    assert sorted(entity["id"] for entity in client.get_all_entities()) == sorted(entity["id"] for entity in entities)
+    assert client.get_entity(entities[5]["id"]) == entities[5]
+    assert client.get_entity("urn:ngsi-ld:Sensor:missing") is None
+
+
+def test_ordered_fetch_merges_the_shards(shards):
+    client = ShardedFiwareClient([stub.endpoint for stub in shards], "token", "test")
+    entities = [make_entity(index) for index in range(120)]
+    client.upload_entities(entities)
+
+    expected = sorted(entities, key=lambda entity: (-entity["level"]["value"], entity["id"]))
+    fetched = list(client.iter_all_entities(page_size=7, order_by="!level,id"))
+    assert [entity["id"] for entity in fetched] == [entity["id"] for entity in expected]
+    assert [entity["id"] for entity in client.get_all_entities(order_by="!level,id")] == [entity["id"] for entity in expected]
+
+
+def test_entity_types_are_merged(shards):
+    client = ShardedFiwareClient([stub.endpoint for stub in shards], "token", "test")
+    client.upload_entities([make_entity(index) for index in range(30)]
+                           + [{"id": "urn:ngsi-ld:Gauge:text", "type": "Gauge", "level": {"type": "Text", "value": "high"}}])
+
+    types = client.get_entity_types()
+    assert [(entity_type["type"], entity_type["count"]) for entity_type in types] == [("Gauge", 11), ("Sensor", 20)]
+    assert sorted(types[0]["attrs"]["level"]["types"]) == ["Number", "Text"]
@@ -0,0 +1,191 @@
+import json
+import re
+
+from geometry_helper import MAX_ENTITY_SIZE_BYTES
+
+# Characters Orion rejects in attribute values (and everywhere else)
+FORBIDDEN_CHARS = "<>\"'=;()"
+# str.translate table that removes the forbidden characters in a single pass
+FORBIDDEN_CHARS_TABLE = str.maketrans("", "", FORBIDDEN_CHARS)
+# Ids, types and attribute/metadata names must be 1-256 printable ASCII characters without
+# whitespace, the forbidden characters and &?/#
+MAX_FIELD_LENGTH = 256
+INVALID_FIELD_CHARS = re.compile(r"""[^!-~]|[&?/#<>"'=;()]""")
+# Finds forbidden characters in the strings of a serialized entity. json.dumps escapes the
+# quotes inside strings (\") but not the ones delimiting them.
+SERIALIZED_FORBIDDEN_CHARS = re.compile(r'[<>\'=;()]|(?<!\\)(?:\\\\)*\\"')
+# Size of an update payload without entities, see geometry_helper.get_entity_size_bytes
+EMPTY_PAYLOAD_SIZE_BYTES = len(json.dumps({"actionType": "append_strict", "entities": []}))
+
+
+def get_field_problem(field):
+    """
+    Returns why a string cannot be used as id, type or attribute/metadata name (None if it can).
+    """
+    if not isinstance(field, str) or not field:
+        return "is empty"
+    if len(field) > MAX_FIELD_LENGTH:
+        return f"is longer than {MAX_FIELD_LENGTH} characters"
+    match = INVALID_FIELD_CHARS.search(field)
+    if match:
+        return f"contains the invalid character {match.group()!r}"
+    return None
+
+
+def sanitize_field(field):
+    """
+    Replaces the invalid characters of an id, type or name with '_' and truncates it.
+    """
+    return INVALID_FIELD_CHARS.sub("_", str(field))[:MAX_FIELD_LENGTH]
+
+
+def has_forbidden_chars(value):
+    """
+    Returns whether a (nested) attribute value contains a string with forbidden characters.
+    """
+    if isinstance(value, str):
+        return len(value.translate(FORBIDDEN_CHARS_TABLE)) != len(value)
+    if isinstance(value, dict):
+        return any(has_forbidden_chars(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(has_forbidden_chars(item) for item in value)
+    return False
+
+
+def sanitize_value(value):
+    """
+    Removes the forbidden characters from all strings of a (nested) attribute value.
+    """
+    if isinstance(value, str):
+        return value.translate(FORBIDDEN_CHARS_TABLE)
+    if isinstance(value, dict):
+        return {key: sanitize_value(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [sanitize_value(item) for item in value]
+    return value
+
+
+def get_field_problems(entity, key_values=False):
+    """
+    Checks the id, the type and the attribute and metadata names and types of an entity.
+    """
+    problems = []
+    if "id" not in entity:
+        problems.append("id is missing")
+    elif get_field_problem(entity["id"]):
+        problems.append(f"id {get_field_problem(entity['id'])}")
+    if "type" in entity and get_field_problem(entity["type"]):
+        problems.append(f"type {get_field_problem(entity['type'])}")
+
+    for name, attribute in entity.items():
+        if name in ("id", "type"):
+            continue
+        if get_field_problem(name):
+            problems.append(f"attribute name {name!r} {get_field_problem(name)}")
+        if key_values:
+            continue
+        if not isinstance(attribute, dict):
+            problems.append(f"attribute {name!r} is not an object with type and value")
+            continue
+        if "type" in attribute and get_field_problem(attribute["type"]):
+            problems.append(f"type of attribute {name!r} {get_field_problem(attribute['type'])}")
+        for metadata_name in (attribute.get("metadata") or {}):
+            if get_field_problem(metadata_name):
+                problems.append(f"metadata name {metadata_name!r} of attribute {name!r} {get_field_problem(metadata_name)}")
+    return problems
+
+
+def get_value_problems(entity, key_values=False):
+    """
+    Checks the attribute and metadata values of an entity for forbidden characters.
+    """
+    problems = []
+    for name, attribute in entity.items():
+        if name in ("id", "type"):
+            continue
+        if key_values or not isinstance(attribute, dict):
+            values = [attribute]
+        else:
+            values = [attribute.get("value")] + [metadata.get("value") if isinstance(metadata, dict) else metadata
+                                                 for metadata in (attribute.get("metadata") or {}).values()]
+        if has_forbidden_chars(values):
+            problems.append(f"attribute {name!r} contains forbidden characters ({FORBIDDEN_CHARS})")
+    return problems
+
+
+def sanitize_entity(entity, key_values=False):
+    """
+    Returns a copy of an entity with valid id, type and names and without forbidden
+    characters in the values.
+    """
+    sanitized = {}
+    for name, attribute in entity.items():
+        if name in ("id", "type"):
+            sanitized[name] = sanitize_field(attribute) if attribute else attribute
+        elif key_values or not isinstance(attribute, dict):
+            sanitized[sanitize_field(name)] = sanitize_value(attribute)
+        else:
+            attribute = dict(attribute)
+            if "type" in attribute:
+                attribute["type"] = sanitize_field(attribute["type"])
+            if "value" in attribute:
+                attribute["value"] = sanitize_value(attribute["value"])
+            if attribute.get("metadata"):
+                attribute["metadata"] = {sanitize_field(metadata_name): sanitize_value(metadata)
+                                         for metadata_name, metadata in attribute["metadata"].items()}
+            sanitized[sanitize_field(name)] = attribute
+    return sanitized
+
+
+def iter_valid_entities(entities, rejected=None, sanitize=False, key_values=False,
+                        max_entity_size_bytes=MAX_ENTITY_SIZE_BYTES, unique_ids=True):
+    """
+    Checks ids, names, forbidden characters, duplicate ids and the size of all entities in a
+    single pass and yields the entities Orion will accept. Each entity is serialized once,
+    the serialized text gives its size and is scanned for forbidden characters, only entities
+    with a hit are checked attribute by attribute.
+
+    Args:
+        entities: List (or any iterable) of entities
+        rejected: List the invalid entities are appended to as (entity, problems) tuples
+        sanitize: Whether invalid names and values are fixed instead of rejected
+        key_values: Whether the entities are in keyValues format
+        max_entity_size_bytes: Size budget for a single-entity update payload
+        unique_ids: Whether entities with an id and type seen before are rejected (append_strict)
+    """
+    if rejected is None:
+        rejected = []
+    seen_ids = set()
+    checked = 0
+    sanitized = 0
+    rejected_before = len(rejected)
+    for entity in entities:
+        checked += 1
+        serialized = json.dumps(entity)
+        problems = get_field_problems(entity, key_values)
+        if SERIALIZED_FORBIDDEN_CHARS.search(serialized):
+            problems += get_value_problems(entity, key_values)
+
+        if problems and sanitize:
+            entity = sanitize_entity(entity, key_values)
+            serialized = json.dumps(entity)
+            # Whatever is left (e.g. a missing id) cannot be fixed
+            problems = get_field_problems(entity, key_values)
+            sanitized += 1
+
+        if not problems and unique_ids:
+            key = (entity["id"], entity.get("type"))
+            if key in seen_ids:
+                problems.append(f"duplicate id {entity['id']}")
+            seen_ids.add(key)
+
+        size = EMPTY_PAYLOAD_SIZE_BYTES + len(serialized.encode("utf-8"))
+        if not problems and size > max_entity_size_bytes:
+            problems.append(f"size {size/1024:.2f} KB exceeds {max_entity_size_bytes/1024:.2f} KB")
+
+        if problems:
+            rejected.append((entity, problems))
+        else:
+            yield entity
+
+    print(f"Validated {checked} entities: {sanitized} sanitized, {len(rejected) - rejected_before} rejected")